@@ -44,9 +44,8 @@ class Node:
                 if not self.blockchain.mine_block():
                     print('Unable to mine, got no wallet ?')
             elif user_choice == '4':
-                if Verification.verify_transactions(
-                        self.blockchain.get_open_transactions(),
-                        self.blockchain.get_balance):
+                if all(Wallet.verify_transactions(
+                        self.blockchain.get_open_transactions())):
                     print('All transactions are valid!!')
                 else:
                     print('There are invalid transactions')
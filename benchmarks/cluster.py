@@ -0,0 +1,500 @@
+""" End to end behaviour of a local cluster of nodes under load.
+
+    python benchmarks/cluster.py --nodes 4 --duration 30 --tx-rate 5
+    python benchmarks/cluster.py --nodes 8 --node-args="--gossip-fanout 3"
+
+Starts N node.py processes on consecutive localhost ports, every one in its
+own temporary directory, connects them through POST /node and creates a
+wallet on every node. Each node mines one block first to fund its wallet.
+Then transactions between random nodes are sent at --tx-rate per second
+and a random node is asked to mine every --mine-interval seconds, while
+the chain tips and mempools of all nodes are sampled.
+
+Reported are the latency from sending a transaction to the block including
+it, the propagation of transactions and blocks to the other nodes, the
+conflicts the nodes noticed (blockchain_conflicts_total), the blocks
+orphaned by forks and the CPU time of every node. Propagation can only be
+measured as finely as --sample-interval. Everything runs on localhost,
+without network access.
+"""
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+
+import requests
+
+NODE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'node.py')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class NodeProcess:
+    """ A node.py process serving on a localhost port. """
+
+    def __init__(self, port, directory, node_args):
+        self.port = port
+        self.url = 'http://localhost:{}'.format(port)
+        self.directory = directory
+        self.public_key = None
+        os.makedirs(directory, exist_ok=True)
+        self.__log = open(os.path.join(directory, 'node.log'), 'w')
+        self.__process = subprocess.Popen(
+            [sys.executable, NODE_PATH, '-p', str(port), '--metrics'] +
+            node_args,
+            cwd=directory, stdout=self.__log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout):
+        """ Returns whether the node answered before the timeout. """
+        deadline = time() + timeout
+        while time() < deadline:
+            if self.__process.poll() is not None:
+                return False
+            try:
+                requests.get(self.url + '/chain/tip', timeout=1)
+                return True
+            except requests.exceptions.RequestException:
+                sleep(0.2)
+        return False
+
+    def cpu_seconds(self):
+        """ Returns the user and system CPU time the process used. """
+        with open('/proc/{}/stat'.format(self.__process.pid)) as f:
+            # The command name may contain spaces, it ends with ')'.
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def stop(self):
+        self.__process.terminate()
+        try:
+            self.__process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.__process.kill()
+            self.__process.wait()
+        self.__log.close()
+
+
+class Recorder:
+    """ Collects the timestamps of the transactions and blocks of a run.
+
+    Transactions are keyed by their signature, which is unique as every
+    transaction sends a distinct amount.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.rejected = 0
+        self.submit_errors = 0
+        self.included = {}
+        self.blocks = {}
+        self.mine_conflicts = 0
+        self.failed_jobs = 0
+        self.tx_arrivals = [{} for node in nodes]
+        self.block_arrivals = [{} for node in nodes]
+
+    def add_block(self, origin, block, finished):
+        with self.lock:
+            self.blocks[block['hash']] = {'origin': origin,
+                                          'index': block['index'],
+                                          'finished': finished}
+            self.block_arrivals[origin].setdefault(block['hash'], finished)
+            for tx in block['transactions']:
+                if tx['sender'] != 'MINING':
+                    self.included.setdefault(tx['signature'], finished)
+
+
+def percentiles(values):
+    """ Returns the count and the p50, p95 and max in milliseconds. """
+    ordered = sorted(values)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1,
+                              int(len(ordered) * 0.95))] * 1000,
+        'max_ms': ordered[-1] * 1000
+    }
+
+
+def start_cluster(args, root):
+    """ Returns the nodes and whether all of them started and were
+    connected.
+    """
+    node_args = shlex.split(args.node_args)
+    nodes = [NodeProcess(args.base_port + number,
+                         os.path.join(root, 'node-{}'.format(number)),
+                         node_args)
+             for number in range(args.nodes)]
+    for node in nodes:
+        if not node.wait_ready(args.startup_timeout):
+            print('Node on port {} did not start, see {}'.format(
+                node.port, os.path.join(node.directory, 'node.log')))
+            return nodes, False
+    for node in nodes:
+        others = [other for other in nodes if other is not node]
+        if args.peers is not None:
+            others = random.sample(others, min(args.peers, len(others)))
+        for other in others:
+            requests.post(node.url + '/node',
+                          json={'node': 'localhost:{}'.format(other.port)})
+    for node in nodes:
+        node.public_key = requests.post(node.url + '/wallet').json()[
+            'public_key']
+    return nodes, True
+
+
+def mine(recorder, number, timeout=600):
+    """ Mines a block on the node and waits for the mining job.
+
+    A node which noticed a conflict refuses to mine, it is resolved and
+    asked again.
+    """
+    node = recorder.nodes[number]
+    response = requests.post(node.url + '/mine')
+    if response.status_code == 409:
+        with recorder.lock:
+            recorder.mine_conflicts += 1
+        requests.post(node.url + '/resolve-conflicts')
+        response = requests.post(node.url + '/mine')
+    if response.status_code != 202:
+        with recorder.lock:
+            recorder.failed_jobs += 1
+        return None
+    job_url = node.url + '/mine/' + response.json()['job']['id']
+    deadline = time() + timeout
+    while time() < deadline:
+        job = requests.get(job_url).json()
+        if job['status'] in ('done', 'failed'):
+            break
+        sleep(0.05)
+    else:
+        job = {'status': 'failed'}
+    if job['status'] != 'done':
+        with recorder.lock:
+            recorder.failed_jobs += 1
+        return None
+    recorder.add_block(number, job['result']['block'], job['finished'])
+    return job['result']['block']
+
+
+def wait_converged(nodes, timeout):
+    """ Returns whether all nodes reached the same tip before the timeout.
+    """
+    deadline = time() + timeout
+    while time() < deadline:
+        tips = {requests.get(node.url + '/chain/tip').json()['hash']
+                for node in nodes}
+        if len(tips) == 1:
+            return True
+        sleep(0.1)
+    return False
+
+
+def send_transaction(recorder, seq):
+    sender, recipient = random.sample(range(len(recorder.nodes)), 2)
+    # Distinct amounts keep the signatures, and so the transactions, unique.
+    amount = round(0.001 + seq * 0.000001, 6)
+    sent = time()
+    try:
+        response = requests.post(
+            recorder.nodes[sender].url + '/transaction',
+            json={'recipient': recorder.nodes[recipient].public_key,
+                  'amount': amount}, timeout=30)
+    except requests.exceptions.RequestException:
+        with recorder.lock:
+            recorder.submit_errors += 1
+        return
+    with recorder.lock:
+        if response.status_code != 200:
+            recorder.rejected += 1
+            return
+        signature = response.json()['transaction']['signature']
+        recorder.sent[signature] = {'origin': sender, 'sent': sent}
+        recorder.tx_arrivals[sender].setdefault(signature, sent)
+
+
+def generate_transactions(recorder, rate, clients, stop):
+    """ Sends rate transactions per second until stop is set. """
+    started = time()
+    seq = 0
+    with ThreadPoolExecutor(clients) as executor:
+        while not stop.is_set():
+            delay = started + seq / rate - time()
+            if delay > 0 and stop.wait(delay):
+                break
+            executor.submit(send_transaction, recorder, seq)
+            seq += 1
+
+
+def schedule_mining(recorder, interval, stop):
+    """ Has a random node mine every interval seconds until stop is set.
+
+    The requests don't wait for each other, so blocks mined at the same
+    time may fork.
+    """
+    threads = []
+    while not stop.wait(interval):
+        thread = threading.Thread(target=mine, args=(
+            recorder, random.randrange(len(recorder.nodes))), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def sample(recorder, interval, stop):
+    """ Records when transactions and blocks first show up on every node.
+    """
+    # The tip of every node and the blocks looked up on it, a block may
+    # only be reported by its miner after the tip changed.
+    tips = [None] * len(recorder.nodes)
+    checked = [set() for node in recorder.nodes]
+    while not stop.wait(interval):
+        for number, node in enumerate(recorder.nodes):
+            try:
+                sample_node(recorder, number, tips, checked[number])
+            except requests.exceptions.RequestException:
+                pass
+
+
+def sample_node(recorder, number, tips, checked):
+    node = recorder.nodes[number]
+    mempool = requests.get(node.url + '/transactions').json()
+    tip = requests.get(node.url + '/chain/tip').json()
+    now = time()
+    with recorder.lock:
+        arrivals = recorder.tx_arrivals[number]
+        for tx in mempool:
+            arrivals.setdefault(tx['signature'], now)
+        if tip['hash'] != tips[number]:
+            tips[number] = tip['hash']
+            checked.clear()
+        arrivals = recorder.block_arrivals[number]
+        pending = {block_hash: block['index']
+                   for block_hash, block in recorder.blocks.items()
+                   if block_hash not in arrivals and
+                   block_hash not in checked and
+                   block['index'] < tip['length']}
+    if not pending:
+        return
+    headers = requests.get(node.url + '/chain/headers',
+                           params={'from': min(pending.values()),
+                                   'to': tip['length']}).json()
+    with recorder.lock:
+        checked.update(pending)
+        for header in headers:
+            if header['hash'] in pending:
+                arrivals.setdefault(header['hash'], now)
+
+
+def scrape_counter(node, name):
+    """ Returns the sum over all labels of a counter of the node. """
+    total = 0.0
+    for line in requests.get(node.url + '/metrics').text.splitlines():
+        if line.startswith(name + '{') or line.startswith(name + ' '):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+
+def report(recorder, final_chain, cpu, duration):
+    results = {'transactions': {}, 'blocks': {}, 'nodes': []}
+    sent = recorder.sent
+    inclusion = [recorder.included[signature] - tx['sent']
+                 for signature, tx in sent.items()
+                 if signature in recorder.included]
+    results['transactions'] = {
+        'sent': len(sent),
+        'rejected': recorder.rejected,
+        'errors': recorder.submit_errors,
+        'not_included': len(sent) - len(inclusion),
+        'inclusion': percentiles(inclusion)
+    }
+    propagation = []
+    unobserved = 0
+    for signature, tx in sent.items():
+        for number, arrivals in enumerate(recorder.tx_arrivals):
+            if number == tx['origin']:
+                continue
+            if signature in arrivals:
+                propagation.append(arrivals[signature] - tx['sent'])
+            else:
+                unobserved += 1
+    results['transactions']['propagation'] = percentiles(propagation)
+    results['transactions']['propagation']['unobserved'] = unobserved
+
+    propagation = []
+    everywhere = []
+    for block_hash, block in recorder.blocks.items():
+        delays = [arrivals[block_hash] - block['finished']
+                  for number, arrivals in enumerate(recorder.block_arrivals)
+                  if number != block['origin'] and block_hash in arrivals]
+        propagation.extend(delays)
+        if len(delays) == len(recorder.nodes) - 1:
+            everywhere.append(max(delays, default=0.0))
+    orphaned = [block_hash for block_hash in recorder.blocks
+                if block_hash not in final_chain]
+    results['blocks'] = {
+        'mined': len(recorder.blocks),
+        'orphaned': len(orphaned),
+        'failed_jobs': recorder.failed_jobs,
+        'mine_refused_for_conflicts': recorder.mine_conflicts,
+        'propagation': percentiles(propagation),
+        'reached_all_nodes': percentiles(everywhere)
+    }
+    for number, node in enumerate(recorder.nodes):
+        results['nodes'].append({
+            'port': node.port,
+            'cpu_seconds': cpu[number],
+            'cpu_percent': cpu[number] / duration * 100,
+            'conflicts': scrape_counter(node, 'blockchain_conflicts_total'),
+            'resolves': scrape_counter(node, 'blockchain_resolve_total')
+        })
+    return results
+
+
+def print_results(results):
+    def latency(name, values, extra=''):
+        if not values['count']:
+            print('  {:24} {:>7} samples'.format(name, 0))
+            return
+        print('  {:24} {:>7} samples  p50 {:>8.1f} ms  p95 {:>8.1f} ms  '
+              'max {:>8.1f} ms{}'.format(name, values['count'],
+                                         values['p50_ms'], values['p95_ms'],
+                                         values['max_ms'], extra))
+
+    transactions = results['transactions']
+    print('Transactions: {} sent, {} rejected, {} errors, {} not '
+          'included'.format(transactions['sent'], transactions['rejected'],
+                            transactions['errors'],
+                            transactions['not_included']))
+    latency('tx to inclusion', transactions['inclusion'])
+    latency('tx propagation', transactions['propagation'],
+            ', {} never sampled'.format(
+                transactions['propagation']['unobserved']))
+    blocks = results['blocks']
+    print('Blocks: {} mined, {} orphaned, {} failed jobs, {} mining '
+          'requests refused for conflicts'.format(
+              blocks['mined'], blocks['orphaned'], blocks['failed_jobs'],
+              blocks['mine_refused_for_conflicts']))
+    latency('block propagation', blocks['propagation'])
+    latency('block on every node', blocks['reached_all_nodes'])
+    print('Nodes:')
+    print('  {:>6} {:>10} {:>8} {:>10} {:>9}'.format(
+        'port', 'cpu s', 'cpu %', 'conflicts', 'resolves'))
+    for node in results['nodes']:
+        print('  {:>6} {:>10.2f} {:>8.1f} {:>10.0f} {:>9.0f}'.format(
+            node['port'], node['cpu_seconds'], node['cpu_percent'],
+            node['conflicts'], node['resolves']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--base-port', type=int, default=6000)
+    parser.add_argument('--peers', type=int, default=None,
+                        help='peers every node adds at random, all others '
+                             'by default')
+    parser.add_argument('--node-args', default='',
+                        help='extra arguments passed to every node.py')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds transactions are sent and blocks mined')
+    parser.add_argument('--tx-rate', type=float, default=5.0,
+                        help='transactions sent per second')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='concurrent transaction requests')
+    parser.add_argument('--mine-interval', type=float, default=5.0)
+    parser.add_argument('--sample-interval', type=float, default=0.25)
+    parser.add_argument('--settle', type=float, default=30.0,
+                        help='seconds the nodes get to agree on a chain')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=None,
+                        help='also write the results as json to this file')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the node directories and logs')
+    args = parser.parse_args()
+    if args.nodes < 2:
+        parser.error('--nodes must be at least 2')
+    random.seed(args.seed)
+
+    root = tempfile.mkdtemp(prefix='cluster-')
+    nodes = []
+    try:
+        nodes, ready = start_cluster(args, root)
+        if not ready:
+            sys.exit(1)
+        recorder = Recorder(nodes)
+        print('Started {} nodes on ports {}-{}, funding the wallets'.format(
+            len(nodes), nodes[0].port, nodes[-1].port))
+        for number in range(len(nodes)):
+            mine(recorder, number)
+            wait_converged(nodes, args.settle)
+        recorder.blocks.clear()
+        recorder.block_arrivals = [{} for node in nodes]
+
+        print('Running for {}s'.format(args.duration))
+        stop = threading.Event()
+        cpu_before = [node.cpu_seconds() for node in nodes]
+        started = time()
+        workers = [
+            threading.Thread(target=generate_transactions, args=(
+                recorder, args.tx_rate, args.clients, stop)),
+            threading.Thread(target=schedule_mining, args=(
+                recorder, args.mine_interval, stop)),
+        ]
+        sampler_stop = threading.Event()
+        sampler = threading.Thread(target=sample, args=(
+            recorder, args.sample_interval, sampler_stop))
+        for thread in workers + [sampler]:
+            thread.start()
+        sleep(args.duration)
+        stop.set()
+        for thread in workers:
+            thread.join()
+        duration = time() - started
+        cpu = [node.cpu_seconds() - before
+               for node, before in zip(nodes, cpu_before)]
+
+        # Mine the remaining transactions, then let the nodes agree.
+        mine(recorder, random.randrange(len(nodes)))
+        for node in nodes:
+            requests.post(node.url + '/resolve-conflicts')
+        converged = wait_converged(nodes, args.settle)
+        sleep(args.sample_interval * 2)
+        sampler_stop.set()
+        sampler.join()
+        final_chain = {header['hash'] for header in requests.get(
+            nodes[0].url + '/chain/headers').json()}
+
+        results = report(recorder, final_chain, cpu, duration)
+        results['converged'] = converged
+        results['arguments'] = vars(args)
+        print_results(results)
+        if not converged:
+            print('The nodes did not agree on a chain within {}s'.format(
+                args.settle))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        for node in nodes:
+            node.stop()
+        if args.keep:
+            print('Node directories kept in {}'.format(root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+""" Throughput and latency of the node's hot paths across chain sizes.
+
+    python benchmarks/run.py --sizes 1000 10000
+    python benchmarks/run.py --sizes 1000 --save-baseline
+    python benchmarks/run.py --sizes 1000 --compare
+
+Synthetic chains (see benchmarks/synthetic.py) are generated
+deterministically and cached in benchmarks/.cache. Every size runs in a
+fresh temporary directory, with two local stub peers answering the
+broadcasts, so no network is needed. --compare exits with status 1 when an
+operation got slower than the baseline by more than the tolerance.
+
+A change which makes an operation faster or slower on purpose re-saves
+benchmarks/baseline.json along with it, so --compare passes at every
+commit.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import synthetic  # noqa: E402
+from block import Block  # noqa: E402
+from blockchain import Blockchain  # noqa: E402
+from miner import Miner  # noqa: E402
+from utility.difficulty import (INITIAL_TARGET, target_bytes,  # noqa: E402
+                                target_hex)
+from utility.storage import BlockStore  # noqa: E402
+from utility.verification import Verification  # noqa: E402
+from wallet import KEY_TYPE_RSA, KEY_TYPES, Wallet  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+NODE_ID = 'bench'
+BALANCE_BATCH = 100
+
+
+class StubPeer:
+    """ A local HTTP server acknowledging every request like a peer. """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(201)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, *args):
+            pass
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return 'localhost:{}'.format(self.server.server_address[1])
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def timed(operation, repetitions):
+    """ Returns the latencies in seconds of repeated calls of operation. """
+    latencies = []
+    for repetition in range(repetitions):
+        started = perf_counter()
+        operation(repetition)
+        latencies.append(perf_counter() - started)
+    return latencies
+
+
+def summary(latencies, items=1):
+    """ Returns throughput and latency percentiles of the latencies.
+
+    Arguments:
+        :latencies: The seconds every call took.
+        :items: The number of items every call processed.
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        'ops_per_second': len(ordered) * items / total if total else 0.0,
+        'mean_ms': total / len(ordered) * 1000,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1,
+                              int(len(ordered) * 0.95))] * 1000
+    }
+
+
+def open_node(source, keep_blocks=None):
+    """ Returns a Blockchain on a copy of the synthetic chain.
+
+    Arguments:
+        :source: The block store directory of the synthetic chain.
+        :keep_blocks: Truncate the copy to this many blocks.
+    """
+    directory = 'blockchain-{}'.format(NODE_ID)
+    shutil.rmtree(directory, ignore_errors=True)
+    shutil.copytree(source, directory)
+    if keep_blocks is not None:
+        store = BlockStore(directory)
+        store.truncate(keep_blocks)
+        store.close()
+    return Blockchain(None, NODE_ID, Miner(workers=1))
+
+
+def run_size(size, args, wallets):
+    source = synthetic.chain_directory(size, args.per_block, args.wallets,
+                                       key_type=args.key_type)
+    chain = BlockStore(source)[:]
+    sender, recipient = wallets[0], wallets[1]
+    results = {}
+
+    latencies = timed(lambda _: open_node(source), 3)
+    results['load_data'] = summary(latencies)
+
+    add_count = min(args.repetitions, len(chain) - 1)
+    node = open_node(source, len(chain) - add_count)
+    blocks = [block.to_dict() for block in chain[len(chain) - add_count:]]
+    latencies = timed(lambda index: node.add_block(blocks[index]), add_count)
+    results['add_block'] = summary(latencies)
+
+    # Single lookups are too fast to time one by one, the clock would
+    # dominate the result.
+    keys = [wallets[index % len(wallets)].public_key
+            for index in range(BALANCE_BATCH)]
+    latencies = timed(lambda _: [node.get_balance(key) for key in keys],
+                      args.repetitions)
+    results['get_balance'] = summary(latencies, len(keys))
+
+    started = perf_counter()
+    assert Verification.verify_chain(chain)
+    results['verify_chain'] = summary([perf_counter() - started],
+                                      len(chain))
+
+    miner = Miner(args.mining_workers)
+    target = target_hex(INITIAL_TARGET)
+    latencies = timed(lambda index: miner.mine(Block.header_prefix(
+        index, chain[-1 - index % len(chain)].hash,
+        chain[-1 - index % len(chain)].merkle_root, index, target),
+        target_bytes(target)), args.repetitions)
+    results['proof_of_work'] = summary(latencies)
+
+    latencies = timed(lambda index: sender.sign_transaction(
+        sender.public_key, recipient.public_key, index), args.repetitions)
+    results['sign_transaction'] = summary(latencies)
+
+    transactions = [synthetic.signed_transaction(
+        sender, recipient.public_key, index / 1000)
+        for index in range(args.repetitions)]
+    latencies = timed(lambda index: Wallet.verify_transaction(
+        transactions[index]), args.repetitions)
+    results['verify_transaction'] = summary(latencies)
+
+    started = perf_counter()
+    Wallet.verify_transactions(transactions)
+    results['verify_transactions'] = summary([perf_counter() - started],
+                                             len(transactions))
+
+    with StubPeer() as first_peer, StubPeer() as second_peer:
+        node.add_peer_node(first_peer)
+        node.add_peer_node(second_peer)
+        latencies = timed(lambda index: node.add_transaction(
+            transactions[index].recipient, transactions[index].sender,
+            transactions[index].signature, transactions[index].amount),
+            args.repetitions)
+        results['add_transaction'] = summary(latencies)
+
+        latencies = timed(lambda _: node.save_data(), args.repetitions)
+        results['save_data'] = summary(latencies)
+
+        node.public_key = sender.public_key
+        latencies = timed(lambda _: node.mine_block(), args.repetitions)
+        results['mine_block'] = summary(latencies)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Prints the change against the baseline, returns the regressions. """
+    regressions = []
+    for size, operations in sorted(results.items(), key=lambda i: int(i[0])):
+        for operation, current in sorted(operations.items()):
+            reference = baseline.get(size, {}).get(operation)
+            if not reference or not reference['ops_per_second']:
+                continue
+            ratio = current['ops_per_second'] / reference['ops_per_second']
+            regressed = ratio < 1 - tolerance
+            print('{:>8} {:20} {:>7.2f}x{}'.format(
+                size, operation, ratio, '  REGRESSION' if regressed else ''))
+            if regressed:
+                regressions.append((size, operation))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='chain sizes in transactions (10^3 to 10^6)')
+    parser.add_argument('--per-block', type=int, default=100)
+    parser.add_argument('--wallets', type=int, default=8)
+    parser.add_argument('--repetitions', type=int, default=50)
+    parser.add_argument('--mining-workers', type=int, default=None)
+    parser.add_argument('--key-type', default=KEY_TYPE_RSA,
+                        choices=KEY_TYPES)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    wallets = synthetic.make_wallets(args.wallets, key_type=args.key_type)
+    results = {}
+    working_directory = os.getcwd()
+    for size in args.sizes:
+        run_directory = tempfile.mkdtemp(prefix='bench-')
+        os.chdir(run_directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[str(size)] = run_size(size, args, wallets)
+        finally:
+            os.chdir(working_directory)
+            shutil.rmtree(run_directory, ignore_errors=True)
+        print('{} transactions'.format(size))
+        print('  {:20} {:>12} {:>10} {:>10} {:>10}'.format(
+            'operation', 'ops/s', 'mean ms', 'p50 ms', 'p95 ms'))
+        for operation, stats in results[str(size)].items():
+            print('  {:20} {:>12.1f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                operation, stats['ops_per_second'], stats['mean_ms'],
+                stats['p50_ms'], stats['p95_ms']))
+
+    if args.save_baseline:
+        with open(args.baseline, mode='w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True))
+        print('Baseline saved to {}'.format(args.baseline))
+    if args.compare:
+        with open(args.baseline, mode='r') as f:
+            baseline = json.loads(f.read())
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import binascii
+import hashlib
+import os
+import random
+import shutil
+
+from Crypto.PublicKey import ECC, RSA
+
+from block import Block
+from blockchain import MINING_REWARD
+from miner import Miner
+from transaction import Transaction
+from utility.difficulty import Difficulty, target_bytes, target_hex
+from utility.merkle import merkle_root
+from utility.storage import BlockStore
+from wallet import KEY_TYPE_ED25519, KEY_TYPE_RSA, Wallet
+
+GENESIS_TIMESTAMP = 1500000000.0
+BLOCK_INTERVAL = 10.0
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '.cache')
+
+
+class DeterministicRandom:
+    """ A byte stream derived from a seed, used as randfunc for RSA keys. """
+
+    def __init__(self, seed):
+        self.__seed = seed.encode()
+        self.__counter = 0
+        self.__buffer = b''
+
+    def read(self, size):
+        while len(self.__buffer) < size:
+            self.__buffer += hashlib.sha256(
+                self.__seed + self.__counter.to_bytes(8, 'big')).digest()
+            self.__counter += 1
+        chunk, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return chunk
+
+
+def make_wallets(count, seed='bench', key_type=KEY_TYPE_RSA):
+    """ Returns count wallets with keys derived from the seed. """
+    wallets = []
+    for number in range(count):
+        randfunc = DeterministicRandom('{}-wallet-{}'.format(seed,
+                                                             number)).read
+        wallet = Wallet('bench-{}'.format(number), key_type)
+        if key_type == KEY_TYPE_ED25519:
+            private_key = ECC.construct(curve='ed25519', seed=randfunc(32))
+            public_key = private_key.public_key().export_key(format='DER')
+            private_key = private_key.export_key(format='DER')
+        else:
+            private_key = RSA.generate(1024, randfunc)
+            public_key = private_key.publickey().exportKey(format='DER')
+            private_key = private_key.exportKey(format='DER')
+        wallet.private_key = binascii.hexlify(private_key).decode('ascii')
+        wallet.public_key = binascii.hexlify(public_key).decode('ascii')
+        wallets.append(wallet)
+    return wallets
+
+
+def signed_transaction(wallet, recipient, amount):
+    return Transaction(wallet.public_key, recipient,
+                       wallet.sign_transaction(wallet.public_key, recipient,
+                                               amount), amount)
+
+
+def make_chain(wallets, transactions, per_block=100, seed='bench'):
+    """ Yields a valid chain holding the given number of transactions.
+
+    Every block pays its mining reward to the next wallet in turn, so the
+    wallets stay funded, and carries up to per_block transfers of small
+    random amounts between funded wallets. Timestamps are fixed, so the
+    same arguments always give the same blocks.
+    """
+    rng = random.Random(seed)
+    miner = Miner(workers=1)
+    difficulty = Difficulty()
+    balances = {}
+    previous = Block(0, '', [], 100, 0)
+    # The blocks a retarget can look back to.
+    recent = {0: previous}
+    yield previous
+    remaining = transactions
+    index = 1
+    while remaining > 0:
+        block_transactions = []
+        funded = [wallet for wallet in wallets
+                  if balances.get(wallet.public_key, 0) >= 1]
+        while funded and len(block_transactions) < min(per_block, remaining):
+            sender = rng.choice(funded)
+            recipient = rng.choice(wallets)
+            amount = rng.randint(1, 100) / 1000
+            if balances[sender.public_key] < amount:
+                funded.remove(sender)
+                continue
+            balances[sender.public_key] -= amount
+            balances[recipient.public_key] = (
+                balances.get(recipient.public_key, 0) + amount)
+            block_transactions.append(signed_transaction(
+                sender, recipient.public_key, amount))
+        remaining -= len(block_transactions)
+        reward_wallet = wallets[index % len(wallets)]
+        block_transactions.append(Transaction.reward(
+            reward_wallet.public_key, index, MINING_REWARD))
+        balances[reward_wallet.public_key] = (
+            balances.get(reward_wallet.public_key, 0) + MINING_REWARD)
+        timestamp = GENESIS_TIMESTAMP + index * BLOCK_INTERVAL
+        target = target_hex(difficulty.next_target(index, recent.get))
+        proof = miner.mine(Block.header_prefix(
+            index, previous.hash,
+            merkle_root([tx.tx_id for tx in block_transactions]), timestamp,
+            target), target_bytes(target))
+        previous = Block(index, previous.hash, block_transactions, proof,
+                         timestamp, target=target)
+        recent[index] = previous
+        recent.pop(index - difficulty.retarget_interval, None)
+        yield previous
+        index += 1
+
+
+def chain_directory(transactions, per_block, wallet_count, seed='bench',
+                    key_type=KEY_TYPE_RSA):
+    """ Returns a block store directory with the synthetic chain.
+
+    Chains are generated once and kept in benchmarks/.cache, since signing
+    a million transactions takes a while.
+    """
+    directory = os.path.join(CACHE_DIRECTORY, 'chain-v4-{}-{}-{}-{}{}'.format(
+        transactions, per_block, wallet_count, seed,
+        '' if key_type == KEY_TYPE_RSA else '-' + key_type))
+    if os.path.exists(os.path.join(directory, 'complete')):
+        return directory
+    shutil.rmtree(directory, ignore_errors=True)
+    store = BlockStore(directory)
+    for block in make_chain(make_wallets(wallet_count, seed, key_type),
+                            transactions, per_block, seed):
+        store.append(block)
+    store.close()
+    open(os.path.join(directory, 'complete'), 'w').close()
+    return directory
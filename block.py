@@ -1,12 +1,86 @@
+import struct
 from time import time
+from transaction import Transaction
+from utility.difficulty import INITIAL_TARGET, target_bytes, target_hex
+from utility.hash_util import hash_block
+from utility.merkle import merkle_root
 from utility.printable import Printable
 
+# index, timestamp, previous hash, Merkle root and target, the nonce
+# follows.
+HEADER = struct.Struct('>qd32s32s32s')
+
 
 class Block(Printable):
+    __slots__ = ('index', 'previous_hash', 'transactions', 'timestamp',
+                 'proof', 'merkle_root', 'target', 'hash')
+
     def __init__(self, index, previous_hash, transactions,
-                 proof, timestamp=None):
+                 proof, timestamp=None, block_hash=None, root=None,
+                 target=None):
         self.index = index
         self.previous_hash = previous_hash
         self.transactions = transactions
         self.timestamp = time() if timestamp is None else timestamp
         self.proof = proof
+        self.merkle_root = (merkle_root([tx.tx_id for tx in transactions])
+                            if root is None else root)
+        self.target = target_hex(INITIAL_TARGET) if target is None else target
+        # Computed once, the block must not be changed afterwards.
+        self.hash = hash_block(self) if block_hash is None else block_hash
+
+    @staticmethod
+    def header_prefix(index, previous_hash, root, timestamp, target):
+        """ Returns the fixed size header the nonce is appended to, raises
+        ValueError on malformed hashes or targets.
+        """
+        try:
+            previous = bytes.fromhex(previous_hash)
+            root_bytes = bytes.fromhex(root)
+            if len(previous) not in (0, 32) or len(root_bytes) != 32:
+                raise ValueError('Hashes must be 32 bytes')
+            return HEADER.pack(index, timestamp, previous, root_bytes,
+                               target_bytes(target))
+        except (TypeError, struct.error) as error:
+            raise ValueError('Malformed block header: {}'.format(error))
+
+    def canonical_bytes(self):
+        """ Returns the header the block hash and the proof of work are
+        computed from. The transactions are only covered by the Merkle root.
+        """
+        return (self.header_prefix(self.index, self.previous_hash,
+                                   self.merkle_root, self.timestamp,
+                                   self.target) +
+                str(self.proof).encode())
+
+    def header(self):
+        """ Returns the dict of the header fields. """
+        return {'index': self.index,
+                'previous_hash': self.previous_hash,
+                'merkle_root': self.merkle_root,
+                'target': self.target,
+                'timestamp': self.timestamp,
+                'proof': self.proof,
+                'hash': self.hash}
+
+    def to_dict(self):
+        """ Returns the dict the block is stored and sent as. """
+        block = self.header()
+        block['transactions'] = [tx.to_dict() for tx in self.transactions]
+        return block
+
+    @classmethod
+    def from_dict(cls, block, trusted=False):
+        """ Returns the Block of a stored or received block dict.
+
+        Arguments:
+            :block: The dict of the block.
+            :trusted: Whether the hash and Merkle root carried by the dict
+                      can be used instead of being computed again.
+        """
+        return cls(block['index'], block['previous_hash'],
+                   [Transaction.from_dict(tx) for tx in block['transactions']],
+                   block['proof'], block['timestamp'],
+                   block.get('hash') if trusted else None,
+                   block.get('merkle_root') if trusted else None,
+                   block.get('target'))
@@ -1,102 +1,440 @@
-import functools
-import hashlib
 import json
-import pickle
+import os
+import re
 import requests
+import threading
+from time import time
 
-from utility.hash_util import hash_block
+from utility import codec, metrics
+from utility.broadcast import QUORUM_NONE, Broadcaster
+from utility.chain_cache import SerializedChain
+from utility.difficulty import Difficulty, target_bytes, target_hex
+from utility.merkle import merkle_proof, merkle_root
+from utility.rwlock import RWLock
+from utility.storage import BlockStore, Journal, load_json, save_json
 from block import Block
+from chain_index import ChainIndex
+from ledger import Ledger
+from mempool import Mempool
+from miner import Miner
 from transaction import Transaction
 from utility.verification import Verification
 from wallet import Wallet
 
 MINING_REWARD = 10
+MAX_BLOCK_TRANSACTIONS = 1000
+SYNC_HEADERS_WINDOW = 64
+CHECKPOINT_INTERVAL = 100
+ADDRESS_PAGE_SIZE = 50
+ADDRESS_PAGE_MAX = 500
+VERIFY_WINDOW = 1024
+SNAPSHOT_INTERVAL = 1000
+SNAPSHOTS_KEPT = 2
+SNAPSHOT_VERSION = 1
+# The mempool journal is compacted into mempool.json once it holds this
+# many records, and more than twice the open transactions.
+JOURNAL_COMPACT_MIN = 1000
 
 
 class Blockchain:
+    """ The chain, the open transactions and the peers of a node.
 
-    def __init__(self, public_key, node_id):
-        genesis_block = Block(0, '', [], 100, 0)
-        self.__chain = [genesis_block]
-        self.__open_transactions = []
+    The state is guarded by a reader/writer lock: reads run concurrently,
+    changes are exclusive. Slow work (proof of work, signature checks and
+    requests to the peers) runs outside of the lock.
+    """
+
+    def __init__(self, public_key, node_id, miner=None, mempool=None,
+                 broadcaster=None, gossip=None, difficulty=None):
+        self.__lock = RWLock()
+        self.__chain = None
+        self.__mempool = Mempool() if mempool is None else mempool
         self.__peer_nodes = set()
         self.public_key = public_key
         self.node_id = node_id
         self.resolve_conflicts = False
-        self.load_data()
+        self.miner = Miner() if miner is None else miner
+        self.broadcaster = (Broadcaster() if broadcaster is None
+                            else broadcaster)
+        # Messages go to every peer, or are gossiped when this is set.
+        self.gossip = gossip
+        self.difficulty = Difficulty() if difficulty is None else difficulty
+        self.__ledger = Ledger()
+        self.__index = ChainIndex()
+        self.__checkpoint = None
+        self.__snapshot_height = -1
+        self.__snapshot_lock = threading.Lock()
+        # Held while a resolve started by catch_up runs.
+        self.__catching_up = threading.Lock()
+        self.__journal = None
+        # Serializes the writers of mempool.json and peers.json.
+        self.__save_lock = threading.Lock()
+        self.__serialized_chain = SerializedChain(self.__binary_record,
+                                                  codec.frame_chain)
+        with self.__lock.write():
+            self.load_data()
+            self.verify_stored_chain()
+            # Only the blocks after the snapshot are booked and indexed.
+            for height in range(self.__load_snapshot() + 1,
+                                len(self.__chain)):
+                block = self.__chain[height]
+                self.__ledger.apply_block(block)
+                self.__index.apply_block(block)
+            # A crash after appending a block, before journaling its
+            # transactions as removed, leaves them in the replayed mempool.
+            self.__mempool.discard([tx.tx_id for tx in self.__mempool
+                                    if self.__confirmed(tx)])
+            self.__block_appended()
+        # Starts a fresh journal after the replayed one.
+        self.save_data()
+
+    def get_chain(self, start=0, end=None):
+        """ Returns the blocks in [start, end) of the chain.
+
+        Arguments:
+            :start: The height of the first block (default 0).
+            :end: The height after the last block (default the chain length).
+        """
+        with self.__lock.read():
+            return self.__chain[start:end]
+
+    def get_serialized_chain(self, binary=False, start=0, end=None):
+        """ Returns the json (or binary) response of the blocks in
+        [start, end). The json is joined from the stored block records,
+        the binary encoding of the blocks at the tip is cached.
+        """
+        with self.__lock.read():
+            if binary:
+                return self.__serialized_chain.serialize(
+                    len(self.__chain), start, end)
+            return b'[' + b','.join(self.__chain.records(start, end)) + b']'
+
+    def __binary_record(self, height):
+        return codec.encode_block(json.loads(
+            self.__chain.records(height, height + 1)[0].decode()))
+
+    def __truncate_chain(self, height):
+        """ Drops the blocks from the given height on, also from the
+        serialization cache.
+        """
+        self.__chain.truncate(height)
+        self.__serialized_chain.truncate(height)
+
+    def get_chain_tip(self):
+        """ Returns the length of the chain and the hash of its tip. """
+        with self.__lock.read():
+            return {'length': len(self.__chain),
+                    'hash': self.__chain.hash_at(-1)}
+
+    def get_chain_headers(self, start=0, end=None):
+        """ Returns the height, hash and previous hash of the blocks in
+        [start, end), read from the block store index only.
+        """
+        with self.__lock.read():
+            return [{'index': height,
+                     'hash': self.__chain.hash_at(height),
+                     'previous_hash': (self.__chain.hash_at(height - 1)
+                                       if height > 0 else '')}
+                    for height in range(*slice(start, end).indices(
+                        len(self.__chain)))]
+
+    def get_transaction_proof(self, tx_id):
+        """ Returns the Merkle inclusion proof of a confirmed transaction
+        with the header of its block, None if it is unknown.
+        """
+        with self.__lock.read():
+            location = self.__index.locate(tx_id)
+            if location is None:
+                return None
+            height, position = location
+            block = self.__chain[height]
+        return {'tx_id': tx_id,
+                'transaction': block.transactions[position].to_dict(),
+                'position': position,
+                'proof': merkle_proof([tx.tx_id for tx in block.transactions],
+                                      position),
+                'header': block.header()}
 
-    def get_chain(self):
-        return self.__chain[:]
+    def get_address_transactions(self, address, offset=0, limit=None):
+        """ Returns a page of the confirmed transactions the address sent
+        or received, in chain order, from the address index.
+
+        Arguments:
+            :address: The public key of the participant.
+            :offset: The number of transactions which are skipped.
+            :limit: The size of the page (default ADDRESS_PAGE_SIZE, at most
+                    ADDRESS_PAGE_MAX).
+        """
+        offset = max(0, offset)
+        limit = min(max(1, ADDRESS_PAGE_SIZE if limit is None else limit),
+                    ADDRESS_PAGE_MAX)
+        with self.__lock.read():
+            total = self.__index.address_count(address)
+            transactions = []
+            block = None
+            for height, position in self.__index.address_locations(
+                    address, offset, offset + limit):
+                if block is None or block.index != height:
+                    block = self.__chain[height]
+                tx = block.transactions[position]
+                transactions.append({
+                    'block_index': height,
+                    'block_hash': block.hash,
+                    'timestamp': block.timestamp,
+                    'position': position,
+                    'tx_id': tx.tx_id,
+                    'direction': ('received' if tx.recipient == address
+                                  else 'sent'),
+                    'transaction': tx.to_dict()})
+        next_offset = offset + len(transactions)
+        return {'address': address,
+                'total': total,
+                'offset': offset,
+                'next_offset': next_offset if next_offset < total else None,
+                'transactions': transactions}
 
     def get_open_transactions(self):
-        return self.__open_transactions[:]
+        with self.__lock.read():
+            return self.__mempool.transactions()
 
     def load_data(self):
-        """ Loads the data from the file. """
+        """ Loads the block store and the rest of the state. """
+        self.__chain = BlockStore(self.data_directory)
+        # Chains of blockchain-<node_id>.txt files are hashed the old way,
+        # they don't link anymore and are synced from the peers instead.
+        if len(self.__chain) == 0:
+            self.__chain.append(Block(0, '', [], 100, 0))
+        self.__load_mempool()
+        self.__peer_nodes = set(load_json(self.__data_path('peers.json'), []))
+        self.__checkpoint = load_json(self.__data_path('checkpoint.json'),
+                                      None)
+
+    def verify_stored_chain(self):
+        """ Verifies the stored blocks after the verified checkpoint.
+
+        Blocks failing the verification are dropped, so they can be synced
+        again from the peers.
+        """
+        start = self.__checkpoint_height() + 1
+        while start < len(self.__chain):
+            end = min(start + VERIFY_WINDOW, len(self.__chain))
+            previous_hash = (self.__chain.hash_at(start - 1) if start > 0
+                             else None)
+            if not Verification.verify_chain(self.__chain[start:end],
+                                             previous_hash, self.difficulty,
+                                             self.__block_at):
+                print('Stored chain is invalid after height {}'.format(
+                    start))
+                self.__truncate_chain(max(start, 1))
+                break
+            start = end
+        self.__save_checkpoint()
+
+    def __checkpoint_height(self):
+        """ Returns the height up to which the chain is verified, -1 if the
+        checkpoint doesn't match the chain.
+        """
         try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='r') as f:
-                file_content = f.readlines()
-                blockchain = json.loads(file_content[0][:-1])
-                updated_blockchain = []
-                for block in blockchain:
-                    converted_tx = [Transaction(tx['sender'], tx['recipient'],
-                                                tx['signature'],
-                                                tx['amount'])
-                                    for tx in block['transactions']]
-                    updated_block = Block(
-                        block['index'], block['previous_hash'], converted_tx,
-                        block['proof'], block['timestamp'])
-                    updated_blockchain.append(updated_block)
-                self.__chain = updated_blockchain
-                open_transactions = json.loads(file_content[1][:-1])
-                updated_open_transactions = []
-                for tx in open_transactions:
-                    updated_tx = Transaction(
-                        tx['sender'], tx['recipient'], tx['signature'],
-                        tx['amount'])
-                    updated_open_transactions.append(updated_tx)
-                self.__open_transactions = updated_open_transactions
-                peer_nodes = json.loads(file_content[2])
-                self.__peer_nodes = set(peer_nodes)
-        except (IOError, IndexError):
-            print('Handled Exception ...')
-        finally:
-            print('Cleanup!')
+            height = self.__checkpoint['height']
+            if (height < len(self.__chain) and
+                    self.__chain.hash_at(height) == self.__checkpoint['hash']):
+                return height
+        except (TypeError, KeyError):
+            pass
+        return -1
+
+    def __save_checkpoint(self):
+        """ Records the tip as verified checkpoint. """
+        self.__checkpoint = {'height': len(self.__chain) - 1,
+                             'hash': self.__chain.hash_at(-1)}
+        try:
+            save_json(self.__data_path('checkpoint.json'), self.__checkpoint)
+        except IOError:
+            print('Saving the checkpoint failed!')
+
+    def __block_appended(self):
+        """ Moves the checkpoint up every CHECKPOINT_INTERVAL blocks and
+        takes a snapshot every SNAPSHOT_INTERVAL blocks.
+        """
+        if (len(self.__chain) - 1 - self.__checkpoint_height() >=
+                CHECKPOINT_INTERVAL):
+            self.__save_checkpoint()
+        if len(self.__chain) - 1 - self.__snapshot_height >= SNAPSHOT_INTERVAL:
+            self.__save_snapshot()
+
+    def __snapshot_heights(self):
+        """ Returns the heights of the stored snapshots, latest first. """
+        return sorted((int(match.group(1)) for match in (
+            re.match(r'snapshot-(\d+)\.json$', name)
+            for name in os.listdir(self.data_directory)) if match),
+            reverse=True)
+
+    def __load_snapshot(self):
+        """ Restores the ledger and the index from the latest snapshot of
+        a block in the chain, returns its height or -1 without one.
+        """
+        for height in self.__snapshot_heights():
+            snapshot = load_json(self.__data_path(
+                'snapshot-{}.json'.format(height)), None)
+            try:
+                if (snapshot['version'] == SNAPSHOT_VERSION and
+                        snapshot['height'] == height and
+                        height < len(self.__chain) and
+                        self.__chain.hash_at(height) == snapshot['hash']):
+                    self.__ledger.restore(snapshot['balances'])
+                    self.__index.restore(snapshot['index'])
+                    self.__snapshot_height = height
+                    return height
+            except (TypeError, KeyError, ValueError):
+                self.__ledger = Ledger()
+                self.__index = ChainIndex()
+            print('Ignoring the snapshot of height {}'.format(height))
+        return -1
+
+    def __save_snapshot(self):
+        """ Snapshots the balances and the index at the tip.
+
+        The state is copied under the lock, it is written on a background
+        thread.
+        """
+        self.__snapshot_height = len(self.__chain) - 1
+        snapshot = {'version': SNAPSHOT_VERSION,
+                    'height': self.__snapshot_height,
+                    'hash': self.__chain.hash_at(-1),
+                    'balances': self.__ledger.snapshot(),
+                    'index': self.__index.snapshot()}
+        threading.Thread(target=self.__write_snapshot, args=(snapshot,),
+                         daemon=True).start()
+
+    def __write_snapshot(self, snapshot):
+        with self.__snapshot_lock:
+            try:
+                save_json(self.__data_path('snapshot-{}.json'.format(
+                    snapshot['height'])), snapshot)
+                for height in self.__snapshot_heights()[SNAPSHOTS_KEPT:]:
+                    os.remove(self.__data_path('snapshot-{}.json'.format(
+                        height)))
+            except (IOError, OSError):
+                print('Saving the snapshot failed!')
 
     def save_data(self):
-        """ Saves the data to the file. """
+        """ Saves the open transactions and the peer nodes.
+
+        The open transactions are saved as a snapshot and their journal
+        starts over. Blocks are not part of it, they are appended to the
+        block store when they are added to the chain. Must not be called
+        with the write lock held, the files are written outside of it.
+        """
         try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='w') as f:
-                saveable_chain = [block.__dict__ for block in
-                                  [Block(block_el.index,
-                                         block_el.previous_hash,
-                                         [tx.__dict__ for tx in
-                                          block_el.transactions],
-                                         block_el.proof, block_el.timestamp)
-                                   for block_el in self.__chain]]
-                f.write(json.dumps(saveable_chain))
-                f.write('\n')
-                saveable_tx = [tx.__dict__ for tx in self.__open_transactions]
-                f.write(json.dumps(saveable_tx))
-                f.write('\n')
-                f.write(json.dumps(list(self.__peer_nodes)))
+            with self.__save_lock, metrics.SAVE_DATA_SECONDS.time():
+                with self.__lock.read():
+                    transactions = [tx.to_dict() for tx in self.__mempool]
+                    peers = list(self.__peer_nodes)
+                    sequence = self.__journal.rotate()
+                written = save_json(self.__data_path('mempool.json'),
+                                    {'sequence': sequence,
+                                     'transactions': transactions})
+                self.__journal.remove_before(sequence)
+                written += save_json(self.__data_path('peers.json'), peers)
+            metrics.SAVE_DATA_BYTES.inc(written)
+        except (IOError, OSError):
+            print('Saving failed!')
+
+    def __load_mempool(self):
+        """ Loads the mempool snapshot and replays its journal. """
+        self.__mempool.clear()
+        saved = load_json(self.__data_path('mempool.json'), [])
+        # Snapshots of older nodes are a plain list, without a journal.
+        if isinstance(saved, list):
+            saved = {'sequence': 0, 'transactions': saved}
+        self.__journal = Journal(self.data_directory, 'mempool')
+        try:
+            for tx in saved['transactions']:
+                self.__mempool.add(Transaction.from_dict(tx))
+            for record in self.__journal.read(saved['sequence']):
+                if 'add' in record:
+                    self.__mempool.add(Transaction.from_dict(record['add']))
+                else:
+                    self.__mempool.discard(record['remove'])
+        except (TypeError, KeyError):
+            print('Ignoring the malformed rest of the mempool')
+
+    def __journal_mempool(self, added=(), removed=()):
+        """ Appends changes of the mempool to its journal, called with the
+        write lock held. __sync_mempool makes them durable.
+        """
+        records = [{'add': tx.to_dict()} for tx in added]
+        if removed:
+            records.append({'remove': [tx.tx_id for tx in removed]})
+        if not records:
+            return
+        try:
+            metrics.SAVE_DATA_BYTES.inc(self.__journal.append(records))
+        except OSError:
+            print('Saving the mempool failed!')
+
+    def __sync_mempool(self):
+        """ Flushes the journal outside of the lock, compacting it into
+        mempool.json once it is long.
+        """
+        try:
+            self.__journal.sync()
+        except OSError:
+            print('Saving the mempool failed!')
+        if self.__journal.entries > max(JOURNAL_COMPACT_MIN,
+                                        2 * len(self.__mempool)):
+            self.save_data()
+
+    def __save_peers(self):
+        """ Saves the peer nodes, outside of the lock. """
+        try:
+            with self.__save_lock:
+                written = save_json(self.__data_path('peers.json'),
+                                    self.get_peer_nodes())
+            metrics.SAVE_DATA_BYTES.inc(written)
         except IOError:
-            print('Serving failed!')
+            print('Saving the peers failed!')
+
+    @property
+    def data_directory(self):
+        return 'blockchain-{}'.format(self.node_id)
+
+    def __data_path(self, name):
+        return os.path.join(self.data_directory, name)
 
     def get_last_blockchain(self):
         """ Returns the last value of the crrent blockchain. """
-        if len(self.__chain) < 1:
-            return None
-        return self.__chain[-1]
+        with self.__lock.read():
+            if len(self.__chain) < 1:
+                return None
+            return self.__chain[-1]
+
+    def proof_of_work(self, transactions, timestamp, target,
+                      generation=None):
+        """ Returns the proof (nonce), None if mining was cancelled.
+
+        Arguments:
+            :transactions: The transactions of the block, with the reward.
+            :timestamp: The timestamp of the block.
+            :target: The hex encoded target of the block.
+            :generation: The miner generation of the tip the block extends.
+        """
+        with self.__lock.read():
+            prefix = Block.header_prefix(
+                len(self.__chain), self.__chain.hash_at(-1),
+                merkle_root([tx.tx_id for tx in transactions]), timestamp,
+                target)
+        # The lock isn't held while mining, a new block cancels the search.
+        return self.miner.mine(prefix, target_bytes(target), generation)
 
-    def proof_of_work(self):
-        """ Returns the proof (nonce). """
-        proof = 0
-        last_hashed_block = hash_block(self.get_last_blockchain())
-        while not Verification.valid_proof(self.__open_transactions,
-                                           last_hashed_block, proof):
-            proof += 1
-        return proof
+    def next_target(self):
+        """ Returns the hex encoded target of the next block. """
+        with self.__lock.read():
+            return target_hex(self.difficulty.next_target(
+                len(self.__chain), self.__block_at))
+
+    def __block_at(self, height):
+        return self.__chain[height]
 
     def get_balance(self, sender=None):
         """ Returns the balance for the given participant. """
@@ -106,23 +444,11 @@ class Blockchain:
             participant = self.public_key
         else:
             participant = sender
-        tx_sender = [[tx.amount for tx in block.transactions if
-                      tx.sender == participant] for block in self.__chain]
-        open_tx_sender = [tx.amount for tx in self.__open_transactions if
-                          tx.sender == participant]
-        tx_sender.append(open_tx_sender)
-        amount_sent = functools.reduce(lambda tx_sum, tx_amnt:
-                                       tx_sum + sum(tx_amnt)
-                                       if len(tx_amnt) > 0
-                                       else tx_sum + 0, tx_sender, 0)
-        tx_recipient = [[tx.amount for tx in block.transactions if
-                         tx.recipient == participant]
-                        for block in self.__chain]
-        amount_recipient = functools.reduce(lambda tx_sum, tx_amnt:
-                                            tx_sum + sum(tx_amnt)
-                                            if len(tx_amnt) > 0
-                                            else tx_sum + 0, tx_recipient, 0)
-        return amount_recipient - amount_sent
+        # Both are single dict lookups, which need no lock. Without the
+        # write lock the two may straddle a block being added, the
+        # balance is then off for as long as the block takes to book.
+        return (self.__ledger.get_balance(participant) -
+                self.__mempool.pending_total(participant))
 
     def add_transaction(self, recipient, sender, signature,
                         amount=1.0, is_recieving=False):
@@ -136,118 +462,376 @@ class Blockchain:
         # if self.public_key is None:
         #    return False
         transaction = Transaction(sender, recipient, signature, amount)
-        if Verification.verify_transaction(transaction, self.get_balance):
-            self.__open_transactions.append(transaction)
-            self.save_data()
-            if not is_recieving:
-                for node in self.__peer_nodes:
-                    url = 'http://{}/broadcast-transaction'.format(node)
-                    try:
-                        response = requests.post(
-                            url, json={'sender': sender,
-                                       'recipient': recipient,
-                                       'signature': signature,
-                                       'amount': amount})
-                        if (response.status_code == 400 or
-                                response.status_code == 500):
-                            print('Transaction declined, need resolving')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        continue
+        if self.__seen_before(transaction.tx_id, is_recieving):
+            return True
+        if not Wallet.verify_transaction(transaction):
+            return False
+        with self.__lock.write():
+            if (transaction.tx_id in self.__mempool or
+                    self.__confirmed(transaction) or
+                    amount > self.get_balance(sender) or
+                    not self.__mempool.add(transaction)):
+                return False
+            self.__journal_mempool(added=[transaction])
+            self.__mark_seen([transaction])
+            peers = list(self.__peer_nodes)
+        self.__sync_mempool()
+        return self.__send(peers, '/broadcast-transaction',
+                           {'sender': sender, 'recipient': recipient,
+                            'signature': signature, 'amount': amount},
+                           self.__on_transaction_response, is_recieving)
+
+    def add_transactions(self, transactions, is_recieving=False):
+        """ Adds a batch of signed transactions.
+
+        The signatures are verified together and the balance of every
+        sender is carried along the batch. The accepted transactions are
+        saved once and sent to every peer in one request.
+
+        Arguments:
+            :transactions: The dicts of the transactions (sender, recipient,
+                           signature and amount).
+            :is_recieving: Whether the batch was relayed by a peer.
+
+        Returns a list telling for each transaction whether it was added
+        and whether the broadcast reached its quorum.
+        """
+        candidates = [Transaction.from_dict(tx) for tx in transactions]
+        seen = [self.__seen_before(tx.tx_id, is_recieving)
+                for tx in candidates]
+        signatures_valid = iter(Wallet.verify_transactions(
+            [tx for tx, tx_seen in zip(candidates, seen) if not tx_seen]))
+        available = {}
+        results = []
+        accepted = []
+        with self.__lock.write():
+            for transaction, tx_seen in zip(candidates, seen):
+                if tx_seen:
+                    results.append(True)
+                    continue
+                signature_valid = next(signatures_valid)
+                sender = transaction.sender
+                if sender not in available:
+                    available[sender] = self.get_balance(sender)
+                added = (signature_valid and sender != 'MINING' and
+                         not self.__confirmed(transaction) and
+                         transaction.amount <= available[sender] and
+                         self.__mempool.add(transaction))
+                if added:
+                    available[sender] -= transaction.amount
+                    accepted.append(transaction)
+                results.append(bool(added))
+            if not accepted:
+                return results, True
+            self.__journal_mempool(added=accepted)
+            self.__mark_seen(accepted)
+            peers = list(self.__peer_nodes)
+        self.__sync_mempool()
+        broadcasted = self.__send(
+            peers, '/broadcast-transactions',
+            {'transactions': [tx.to_dict() for tx in accepted]},
+            self.__on_transaction_response, is_recieving)
+        return results, broadcasted
+
+    def __seen_before(self, message_id, is_recieving):
+        """ Returns True for copies of a message the peers relayed before,
+        those are acknowledged without being processed again.
+        """
+        return (is_recieving and self.gossip is not None and
+                message_id in self.gossip.seen)
+
+    def __confirmed(self, transaction):
+        """ Returns whether the transaction is in a block of the chain, late
+        copies of it must not be mined again.
+        """
+        return self.__index.locate(transaction.tx_id) is not None
+
+    def __mark_seen(self, transactions):
+        """ Records the ids of accepted or confirmed transactions. Rejected
+        ones aren't recorded, they may be valid once the sender's funds
+        arrive.
+        """
+        if self.gossip is not None:
+            for transaction in transactions:
+                self.gossip.seen.add(transaction.tx_id)
+
+    def __send(self, peers, path, payload, on_response, is_recieving):
+        """ Sends a message to the peers, returns whether the quorum
+        acknowledged it.
+
+        Without gossip every peer gets the messages of this node and
+        received messages aren't forwarded. With gossip a random subset
+        of the peers gets the message, received ones are relayed without
+        waiting for acknowledgements.
+        """
+        if self.gossip is None:
+            if is_recieving:
+                return True
+            return self.broadcaster.broadcast(peers, path, payload,
+                                              on_response)
+        # Peers with an open circuit would waste a slot of the fanout.
+        peers = self.gossip.select(self.broadcaster.health.available(peers))
+        if is_recieving:
+            self.broadcaster.broadcast(peers, path, payload, on_response,
+                                       QUORUM_NONE)
             return True
-        return False
+        return self.broadcaster.broadcast(peers, path, payload, on_response)
+
+    @staticmethod
+    def __on_transaction_response(node, response):
+        if response is not None and (response.status_code == 400 or
+                                     response.status_code == 500):
+            print('Transaction declined by {}, need resolving'.format(node))
+
+    def has_block(self, block_hash):
+        """ Returns whether the block with the given hash is in the chain.
+        """
+        with self.__lock.read():
+            return self.__chain.height_of(block_hash) is not None
 
     def add_block(self, block):
-        transactions = [Transaction(tx['sender'], tx['recipient'],
-                                    tx['signature'], tx['amount'])
+        """ Appends a block of a peer to the chain.
+
+        Returns True if the block was added, None if it is in the chain
+        already (gossip delivers blocks more than once) and False if it
+        is invalid or doesn't extend the tip.
+
+        Arguments:
+            :block: The dict of the block.
+        """
+        transactions = [Transaction.from_dict(tx)
                         for tx in block['transactions']]
-        proof_is_valid = Verification.valid_proof(
-            transactions[:-1], block['previous_hash'], block['proof'])
-        hashes_match = hash_block(self.__chain[-1]) == block['previous_hash']
-        if not proof_is_valid or not hashes_match:
+        try:
+            converted_block = Block(block['index'], block['previous_hash'],
+                                    transactions, block['proof'],
+                                    block['timestamp'],
+                                    target=block.get('target'))
+            header_is_valid = Verification.valid_header(
+                *Verification.header_input(converted_block))
+        except ValueError:
             return False
-        converted_block = Block(block['index'], block['previous_hash'],
-                                transactions, block['proof'],
-                                block['timestamp'])
-        self.__chain.append(converted_block)
-        stored_transactions = self.__open_transactions[:]
-        for itx in block['transactions']:
-            for opentx in stored_transactions:
-                if (opentx.sender == itx['sender'] and
-                        opentx.recipient == itx['recipient'] and
-                        opentx.signature == itx['signature'] and
-                        opentx.amount == itx['amount']):
-                    try:
-                        self.__open_transactions.remove(opentx)
-                    except ValueError:
-                        print('Item was already removed')
-        self.save_data()
+        claims_match = (
+            block.get('hash', converted_block.hash) == converted_block.hash and
+            block.get('merkle_root', converted_block.merkle_root) ==
+            converted_block.merkle_root)
+        if (not header_is_valid or not claims_match or
+                not all(Wallet.verify_transactions(transactions))):
+            return False
+        with self.__lock.write():
+            if self.__chain.height_of(converted_block.hash) is not None:
+                return None
+            if (converted_block.index != len(self.__chain) or
+                    self.__chain.hash_at(-1) != block['previous_hash'] or
+                    converted_block.target != target_hex(
+                        self.difficulty.next_target(len(self.__chain),
+                                                    self.__block_at)) or
+                    not self.difficulty.valid_timestamp(
+                        len(self.__chain), converted_block.timestamp,
+                        self.__block_at) or
+                    any(self.__confirmed(tx) for tx in transactions
+                        if tx.sender != 'MINING')):
+                return False
+            self.__chain.append(converted_block)
+            self.__ledger.apply_block(converted_block)
+            self.__index.apply_block(converted_block)
+            self.__block_appended()
+            self.miner.cancel()
+            self.__mempool.remove(transactions)
+            self.__journal_mempool(removed=transactions)
+            self.__mark_seen(transactions)
+            peers = list(self.__peer_nodes)
+        self.__sync_mempool()
+        if self.gossip is not None:
+            # Known blocks are recognized by the chain index, no need for
+            # the seen filter.
+            self.__send(peers, '/broadcast-block',
+                        {'block': converted_block.to_dict()},
+                        self.__on_block_response, True)
         return True
 
     def mine_block(self):
         """ Mines a new block. """
         if self.public_key is None:
             return None
-        last_block = self.__chain[-1]
-        hashed_block = hash_block(last_block)
-        proof = self.proof_of_work()
-        reward_transaction = Transaction('MINING', self.public_key, '',
-                                         MINING_REWARD)
-        copied_transactions = self.__open_transactions[:]
-        for tx in copied_transactions:
-            if not Wallet.verify_transaction(tx):
+        with self.__lock.read():
+            height = len(self.__chain)
+            hashed_block = self.__chain.hash_at(-1)
+            # A block added from now on cancels the search, even if it
+            # arrives before the search started.
+            generation = self.miner.generation()
+            target = self.next_target()
+            median_time = self.difficulty.median_time(height, self.__block_at)
+            copied_transactions = self.__mempool.select(
+                MAX_BLOCK_TRANSACTIONS)
+        if not all(Wallet.verify_transactions(copied_transactions)):
+            return None
+        # The reward is part of the Merkle root the proof of work covers.
+        copied_transactions.append(Transaction.reward(
+            self.public_key, height, MINING_REWARD))
+        # The local clock may be behind the blocks of the peers.
+        timestamp = max(time(), median_time + 0.001)
+        proof = self.proof_of_work(copied_transactions, timestamp, target,
+                                   generation)
+        with self.__lock.write():
+            if proof is None or self.__chain.hash_at(-1) != hashed_block:
+                print('Mining was cancelled, a block for this height arrived')
                 return None
-        copied_transactions.append(reward_transaction)
-        block = Block(len(self.__chain), hashed_block,
-                      copied_transactions, proof)
-        self.__chain.append(block)
-        self.__open_transactions = []
-        self.save_data()
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-block'.format(node)
-            converted_block = block.__dict__.copy()
-            converted_block['transactions'] = [tx.__dict__ for tx in
-                                               converted_block['transactions']]
-            try:
-                response = requests.post(url, json={'block': converted_block})
-                if (response.status_code == 400 or
-                        response.status_code == 500):
-                    print('Transaction declined, need resolving')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
-                print("Got connection error .. ")
-                continue
+            block = Block(height, hashed_block, copied_transactions, proof,
+                          timestamp, target=target)
+            self.__chain.append(block)
+            # Transactions which arrived while mining stay open.
+            self.__mempool.remove(copied_transactions[:-1])
+            self.__ledger.apply_block(block)
+            self.__index.apply_block(block)
+            self.__block_appended()
+            self.__journal_mempool(removed=copied_transactions[:-1])
+            self.__mark_seen(copied_transactions)
+            peers = list(self.__peer_nodes)
+        self.__sync_mempool()
+        self.__send(peers, '/broadcast-block', {'block': block.to_dict()},
+                    self.__on_block_response, False)
         return block
 
+    def __on_block_response(self, node, response):
+        if response is None:
+            return
+        if response.status_code == 400 or response.status_code == 500:
+            print('Block declined by {}, need resolving'.format(node))
+        if response.status_code == 409:
+            self.resolve_conflicts = True
+            metrics.CONFLICTS_TOTAL.inc(source='block_response')
+
     def resolve(self):
-        winner_chain = self.__chain
-        replace = False
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node)
+        """ Replaces the chain with the longest valid chain of the peers.
+
+        Only the tip of every peer is fetched first. For a longer chain the
+        common ancestor is searched on the block hashes, then only the
+        blocks after it are downloaded and verified. The peers are queried
+        fastest first.
+        """
+        with metrics.RESOLVE_SECONDS.time():
+            replaced = self.__resolve()
+        metrics.RESOLVE_TOTAL.inc(outcome='replaced' if replaced else 'kept')
+        return replaced
+
+    def catch_up(self):
+        """ Resolves on a background thread, unless such a resolve is
+        running already.
+
+        With gossip a node misses blocks now and then, it syncs once a
+        later block arrives. The new tip is relayed, so the peers behind
+        this node catch up as well.
+        """
+        if not self.__catching_up.acquire(blocking=False):
+            return
+        threading.Thread(target=self.__catch_up, daemon=True).start()
+
+    def __catch_up(self):
+        try:
+            if not self.resolve() or self.gossip is None:
+                return
+            with self.__lock.read():
+                tip = self.__chain[-1]
+                peers = list(self.__peer_nodes)
+            self.__send(peers, '/broadcast-block', {'block': tip.to_dict()},
+                        self.__on_block_response, True)
+        finally:
+            self.__catching_up.release()
+
+    def __resolve(self):
+        # The peers are queried without holding the lock, the chain is only
+        # locked to replace its suffix.
+        best = None
+        best_length = len(self.__chain)
+        # The fastest peer with the longest chain serves the download, peers
+        # with an open circuit are skipped.
+        peers = self.broadcaster.health.available(self.get_peer_nodes())
+        for node in peers:
             try:
-                response = requests.get(url)
-                node_chain = response.json()
-                node_chain = [Block(block['index'], block['previous_hash'],
-                                    [Transaction(tx['sender'], tx['recipient'],
-                                                 tx['signature'], tx['amount'])
-                                     for tx in block['transactions']],
-                                    block['proof'], block['timestamp'])
-                              for block in node_chain]
-                node_chain_len = len(node_chain)
-                local_cahin_length = len(winner_chain)
-                if (node_chain_len > local_cahin_length and
-                        Verification.verify_chain(node_chain)):
-                    winner_chain = node_chain
-                    replace = True
-            except requests.exceptions.ConnectionError:
+                tip = self.broadcaster.get(node, '/chain/tip').json()
+                if tip['length'] <= best_length:
+                    continue
+                fork = self.__find_fork(node, tip['length'])
+                suffix = [Block.from_dict(block)
+                          for block in self.broadcaster.fetch(
+                              node, '/chain', params={'from': fork})]
+                previous_hash = (self.__chain.hash_at(fork - 1)
+                                 if fork > 0 else None)
+                if (fork + len(suffix) > best_length and
+                        suffix and suffix[0].index == fork and
+                        Verification.verify_chain(suffix, previous_hash,
+                                                  self.difficulty,
+                                                  self.__block_at)):
+                    best = (fork, suffix)
+                    best_length = fork + len(suffix)
+            except (requests.exceptions.RequestException, ValueError,
+                    KeyError, TypeError, IndexError):
                 continue
-        self.resolve_conflicts = False
-        self.__chain = winner_chain
-        if replace:
-            self.__open_transactions = []
-        self.save_data()
-        return replace
+        with self.__lock.write():
+            self.resolve_conflicts = False
+            replaced = best is not None and self.__replace_suffix(*best)
+        if replaced:
+            # The mempool was revalidated, it is saved as a new snapshot.
+            self.save_data()
+        return replaced
+
+    def __find_fork(self, node, peer_length):
+        """ Returns the height of the first block which differs from the
+        chain of the peer.
+
+        The block hashes of the peer are fetched backwards from the shorter
+        tip, in windows doubling in size, until a matching hash is found.
+        """
+        end = min(len(self.__chain), peer_length)
+        window = SYNC_HEADERS_WINDOW
+        while end > 0:
+            start = max(0, end - window)
+            headers = self.broadcaster.get(
+                node, '/chain/headers',
+                params={'from': start, 'to': end}).json()
+            for header in reversed(headers):
+                height = header['index']
+                if (height < len(self.__chain) and
+                        self.__chain.hash_at(height) == header['hash']):
+                    return height + 1
+            end = start
+            window *= 2
+        return 0
+
+    def __replace_suffix(self, fork, suffix):
+        """ Replaces the blocks from the fork height on with the suffix,
+        returns False if the chain changed so that it doesn't apply anymore.
+        """
+        if (fork > len(self.__chain) or
+                fork + len(suffix) <= len(self.__chain) or
+                suffix[0].previous_hash != (self.__chain.hash_at(fork - 1)
+                                            if fork > 0 else '')):
+            return False
+        for block in reversed(self.__chain[fork:]):
+            self.__ledger.revert_block(block)
+            self.__index.revert_block(block)
+        self.__truncate_chain(fork)
+        self.miner.cancel()
+        for block in suffix:
+            self.__chain.append(block)
+            self.__ledger.apply_block(block)
+            self.__index.apply_block(block)
+            self.__mempool.remove(block.transactions)
+            self.__mark_seen(block.transactions)
+        # The suffix was verified before it replaced the chain.
+        self.__save_checkpoint()
+        self.__snapshot_height = min(self.__snapshot_height, fork - 1)
+        self.__block_appended()
+        self.__revalidate_mempool()
+        return True
+
+    def __revalidate_mempool(self):
+        """ Drops the open transactions the new balances can't cover. """
+        open_transactions = self.__mempool.transactions()
+        self.__mempool.clear()
+        for tx in open_transactions:
+            if tx.amount <= self.get_balance(tx.sender):
+                self.__mempool.add(tx)
 
     def add_peer_node(self, node):
         """ Add a new node to the peer set.
@@ -255,8 +839,9 @@ class Blockchain:
         Arguments:
             :node: The node url which should be added.
         """
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.__lock.write():
+            self.__peer_nodes.add(node)
+        self.__save_peers()
 
     def remove_peer_node(self, node):
         """ Remove the node from the peer set.
@@ -264,11 +849,14 @@ class Blockchain:
         Arguments:
             :node: The node url which should be removed.
         """
-        self.__peer_nodes.discard(node)
-        print(self.__peer_nodes)
-        print(node)
-        self.save_data()
+        with self.__lock.write():
+            self.__peer_nodes.discard(node)
+            print(self.__peer_nodes)
+            print(node)
+        self.__save_peers()
+        self.broadcaster.drop_session(node)
 
     def get_peer_nodes(self):
         """ Fetches all the peer nodes. """
-        return list(self.__peer_nodes)
+        with self.__lock.read():
+            return list(self.__peer_nodes)
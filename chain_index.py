@@ -0,0 +1,130 @@
+import base64
+import sys
+from array import array
+
+# Locations are packed into one integer, the height in the upper bits.
+_POSITION_BITS = 32
+
+
+class ChainIndex:
+    """ Keeps the location of every confirmed transaction keyed by tx id and
+    by the addresses (public keys) sending and receiving it.
+
+    Like the Ledger it is updated block by block, so a transaction or the
+    history of an address is found without scanning the chain.
+    """
+
+    def __init__(self):
+        self.__locations = {}
+        # Packed locations in chain order, 8 bytes per entry.
+        self.__addresses = {}
+
+    def locate(self, tx_id):
+        """ Returns the (height, position) of the transaction or None.
+
+        Arguments:
+            :tx_id: The id of the transaction.
+        """
+        return self.__locations.get(tx_id)
+
+    def address_count(self, address):
+        """ Returns the number of transactions of the address. """
+        return len(self.__addresses.get(address, ()))
+
+    def address_locations(self, address, start=0, end=None):
+        """ Returns the (height, position) of the transactions in [start,
+        end) of those the address sent or received, in chain order.
+
+        Arguments:
+            :address: The public key of the participant.
+            :start: The number of transactions which are skipped.
+            :end: The number of transactions after the last one returned.
+        """
+        mask = (1 << _POSITION_BITS) - 1
+        return [(location >> _POSITION_BITS, location & mask)
+                for location in self.__addresses.get(address, ())[start:end]]
+
+    def apply_block(self, block):
+        """ Indexes the transactions of a confirmed block.
+
+        Arguments:
+            :block: The block which was appended to the chain.
+        """
+        for position, tx in enumerate(block.transactions):
+            self.__locations[tx.tx_id] = (block.index, position)
+            location = (block.index << _POSITION_BITS) | position
+            for address in self.__participants(tx):
+                locations = self.__addresses.get(address)
+                if locations is None:
+                    locations = self.__addresses[address] = array('q')
+                locations.append(location)
+
+    def revert_block(self, block):
+        """ Removes the transactions of a block removed from the chain.
+
+        Arguments:
+            :block: The block which was removed from the chain.
+        """
+        for tx in block.transactions:
+            location = self.__locations.get(tx.tx_id)
+            # Rewards mined before they carried the height are identical,
+            # their entry points to the latest block.
+            if location is not None and location[0] == block.index:
+                del self.__locations[tx.tx_id]
+            # Blocks are reverted from the tip, their entries are the last.
+            for address in self.__participants(tx):
+                locations = self.__addresses.get(address)
+                if locations and (locations[-1] >> _POSITION_BITS ==
+                                  block.index):
+                    locations.pop()
+                    if not locations:
+                        del self.__addresses[address]
+
+    def snapshot(self):
+        """ Returns the index as a json serializable dict, see restore. """
+        return {'locations': {tx_id: (height << _POSITION_BITS) | position
+                              for tx_id, (height, position)
+                              in self.__locations.items()},
+                'addresses': {address: self.__encode_locations(locations)
+                              for address, locations
+                              in self.__addresses.items()}}
+
+    def restore(self, snapshot):
+        """ Replaces the index with the one of a snapshot.
+
+        Arguments:
+            :snapshot: The dict returned by snapshot.
+        """
+        mask = (1 << _POSITION_BITS) - 1
+        self.__locations = {tx_id: (location >> _POSITION_BITS,
+                                    location & mask)
+                            for tx_id, location
+                            in snapshot['locations'].items()}
+        self.__addresses = {address: self.__decode_locations(locations)
+                            for address, locations
+                            in snapshot['addresses'].items()}
+
+    @staticmethod
+    def __encode_locations(locations):
+        # Stored little endian, whatever the byte order of the machine.
+        if sys.byteorder == 'big':
+            locations = array('q', locations)
+            locations.byteswap()
+        return base64.b64encode(locations.tobytes()).decode('ascii')
+
+    @staticmethod
+    def __decode_locations(encoded):
+        locations = array('q')
+        locations.frombytes(base64.b64decode(encoded))
+        if sys.byteorder == 'big':
+            locations.byteswap()
+        return locations
+
+    @staticmethod
+    def __participants(tx):
+        """ Returns the addresses a transaction is listed under. """
+        if tx.sender == 'MINING':
+            return (tx.recipient,)
+        if tx.sender == tx.recipient:
+            return (tx.sender,)
+        return (tx.sender, tx.recipient)
@@ -0,0 +1,57 @@
+class Ledger:
+    """ Keeps the confirmed account balances keyed by public key.
+
+    Balances are updated block by block, so a balance lookup never has to
+    scan the chain. Amounts of open transactions are tracked by the Mempool.
+    """
+
+    def __init__(self):
+        self.__balances = {}
+
+    def get_balance(self, participant):
+        """ Returns the confirmed balance of the participant.
+
+        Arguments:
+            :participant: The public key of the participant.
+        """
+        return self.__balances.get(participant, 0)
+
+    def apply_block(self, block):
+        """ Books the transactions of a confirmed block.
+
+        Arguments:
+            :block: The block which was appended to the chain.
+        """
+        for tx in block.transactions:
+            self.__add(self.__balances, tx.sender, -tx.amount)
+            self.__add(self.__balances, tx.recipient, tx.amount)
+
+    def revert_block(self, block):
+        """ Takes back the transactions of a block removed from the chain.
+
+        Arguments:
+            :block: The block which was removed from the chain.
+        """
+        for tx in block.transactions:
+            self.__add(self.__balances, tx.sender, tx.amount)
+            self.__add(self.__balances, tx.recipient, -tx.amount)
+
+    def snapshot(self):
+        """ Returns a copy of the balances, see restore. """
+        return dict(self.__balances)
+
+    def restore(self, balances):
+        """ Replaces the balances with those of a snapshot.
+
+        Arguments:
+            :balances: The balances returned by snapshot.
+        """
+        self.__balances = dict(balances)
+
+    @staticmethod
+    def __add(accounts, participant, amount):
+        total = accounts.get(participant, 0) + amount
+        if total == 0:
+            accounts.pop(participant, None)
+        else:
+            accounts[participant] = total
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+MEMPOOL_MAX_SIZE = 10000
+EVICT_OLDEST = 'oldest'
+REJECT_NEW = 'reject'
+
+
+class Mempool:
+    """ The open transactions, indexed by transaction id.
+
+    Transactions are kept in arrival order. The amount every sender has
+    pending is tracked along, so balance checks don't scan the pool. Once
+    the pool holds max_size transactions, the eviction policy either drops
+    the oldest transaction or rejects the new one.
+    """
+
+    def __init__(self, max_size=None, eviction=EVICT_OLDEST):
+        if eviction not in (EVICT_OLDEST, REJECT_NEW):
+            raise ValueError('Unknown eviction policy {}'.format(eviction))
+        self.max_size = MEMPOOL_MAX_SIZE if max_size is None else max_size
+        self.eviction = eviction
+        self.__transactions = OrderedDict()
+        self.__pending = {}
+
+    def __len__(self):
+        return len(self.__transactions)
+
+    def __iter__(self):
+        return iter(list(self.__transactions.values()))
+
+    def __contains__(self, tx_id):
+        return tx_id in self.__transactions
+
+    def transactions(self):
+        """ Returns the open transactions in arrival order. """
+        return list(self.__transactions.values())
+
+    def pending_total(self, sender):
+        """ Returns the amount the sender has in open transactions. """
+        return self.__pending.get(sender, 0)
+
+    def add(self, transaction):
+        """ Adds a transaction, returns False for duplicates or a full pool.
+
+        Arguments:
+            :transaction: The transaction which should be added.
+        """
+        tx_id = transaction.tx_id
+        if tx_id in self.__transactions:
+            return False
+        if len(self.__transactions) >= self.max_size:
+            if self.eviction == REJECT_NEW or self.max_size <= 0:
+                return False
+            evicted_id = next(iter(self.__transactions))
+            print('Mempool full, evicting {}'.format(evicted_id))
+            self.__discard(evicted_id)
+        self.__transactions[tx_id] = transaction
+        self.__book(transaction.sender, transaction.amount)
+        return True
+
+    def remove(self, transactions):
+        """ Removes the given transactions, e.g. the ones of a new block.
+
+        Arguments:
+            :transactions: The transactions which should be removed.
+        """
+        self.discard(transaction.tx_id for transaction in transactions)
+
+    def discard(self, tx_ids):
+        """ Removes the transactions with the given ids, if open. """
+        for tx_id in tx_ids:
+            self.__discard(tx_id)
+
+    def select(self, limit=None):
+        """ Returns up to limit open transactions, the oldest first. """
+        if limit is None:
+            return self.transactions()
+        selected = []
+        for transaction in self.__transactions.values():
+            if len(selected) >= limit:
+                break
+            selected.append(transaction)
+        return selected
+
+    def clear(self):
+        self.__transactions = OrderedDict()
+        self.__pending = {}
+
+    def __discard(self, tx_id):
+        transaction = self.__transactions.pop(tx_id, None)
+        if transaction is not None:
+            self.__book(transaction.sender, -transaction.amount)
+
+    def __book(self, sender, amount):
+        total = self.__pending.get(sender, 0) + amount
+        if total == 0:
+            self.__pending.pop(sender, None)
+        else:
+            self.__pending[sender] = total
@@ -0,0 +1,167 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+from time import time
+
+from utility import metrics
+
+MINING_WORKERS = os.cpu_count() or 1
+MINING_BATCH_SIZE = 10000
+
+
+def search_batch(prefix_hash, target, start, stop):
+    """ Returns the first valid proof in [start, stop) or None.
+
+    Arguments:
+        :prefix_hash: The sha256 object which already consumed the prefix.
+        :target: The 32 big endian bytes the digest must be below.
+        :start: The first nonce which should be tried.
+        :stop: The nonce at which the search stops.
+    """
+    for proof in range(start, stop):
+        guess_hash = prefix_hash.copy()
+        guess_hash.update(str(proof).encode())
+        # Same check as Verification.valid_header, bytes compare as numbers.
+        if guess_hash.digest() < target:
+            return proof
+    return None
+
+
+def _mine_worker(prefix, target, worker, workers, batch_size, stop, tried,
+                 results):
+    """ Searches every `workers`-th batch of the nonce space. """
+    prefix_hash = hashlib.sha256(prefix)
+    batch = worker
+    while not stop.is_set():
+        start = batch * batch_size
+        proof = search_batch(prefix_hash, target, start, start + batch_size)
+        if proof is None:
+            with tried.get_lock():
+                tried.value += batch_size
+        else:
+            with tried.get_lock():
+                tried.value += proof - start + 1
+            results.put(proof)
+            return
+        batch += workers
+
+
+class Miner:
+    """ Searches the proof of work on a pool of processes.
+
+    The nonce space is split into batches which are handed out round robin
+    to the workers. Every worker hashes the prefix (the transactions and the
+    last hash) once and only appends the nonce for each attempt.
+
+    Every cancel starts a new generation. A search started for an older
+    generation returns right away, so a cancel issued before the search
+    began isn't lost.
+    """
+
+    def __init__(self, workers=None, batch_size=None):
+        self.workers = MINING_WORKERS if workers is None else max(1, workers)
+        self.batch_size = (MINING_BATCH_SIZE if batch_size is None
+                           else max(1, batch_size))
+        self.last_stats = None
+        self.__cancelled = multiprocessing.Event()
+        self.__generation = 0
+        self.__generation_lock = threading.Lock()
+        self.__tried = multiprocessing.Value('q', 0)
+        self.__started = None
+
+    def cancel(self):
+        """ Aborts the running search, if any, and the ones started for
+        the current generation.
+        """
+        with self.__generation_lock:
+            self.__generation += 1
+        self.__cancelled.set()
+
+    def generation(self):
+        """ Returns the generation a search started now belongs to. """
+        return self.__generation
+
+    def progress(self):
+        """ Returns the nonces tried and seconds spent by the running
+        search, None when the miner is idle.
+        """
+        started = self.__started
+        if started is None:
+            return None
+        return {'nonces': self.__tried.value, 'seconds': time() - started}
+
+    def mine(self, prefix, target, generation=None):
+        """ Returns a valid proof for the prefix, None when cancelled.
+
+        Arguments:
+            :prefix: The bytes of the guess preceding the nonce.
+            :target: The 32 big endian bytes the digest must be below.
+            :generation: The generation the search was prepared in, it is
+                         cancelled if a cancel happened since.
+        """
+        self.__cancelled.clear()
+        # cancel counts up before it sets the event, so a cancel after the
+        # clear is seen either here or by the search.
+        if generation is not None and generation != self.__generation:
+            print('Mining was cancelled before it started')
+            return None
+        self.__tried.value = 0
+        started = self.__started = time()
+        try:
+            if self.workers == 1:
+                proof = self.__mine_inline(prefix, target)
+            else:
+                proof = self.__mine_pool(prefix, target)
+        finally:
+            self.__started = None
+        tried = self.__tried.value
+        elapsed = time() - started
+        metrics.MINING_SECONDS.observe(elapsed)
+        metrics.MINING_NONCES.inc(tried)
+        self.last_stats = {
+            'nonces': tried,
+            'seconds': elapsed,
+            'nonces_per_second': tried / elapsed if elapsed > 0 else 0.0
+        }
+        print('Mining tried {} nonces ({:.0f}/s)'.format(
+            tried, self.last_stats['nonces_per_second']))
+        return proof
+
+    def __mine_inline(self, prefix, target):
+        prefix_hash = hashlib.sha256(prefix)
+        start = 0
+        while not self.__cancelled.is_set():
+            proof = search_batch(prefix_hash, target, start,
+                                 start + self.batch_size)
+            if proof is not None:
+                self.__tried.value = proof + 1
+                return proof
+            start += self.batch_size
+            self.__tried.value = start
+        return None
+
+    def __mine_pool(self, prefix, target):
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=_mine_worker,
+            args=(prefix, target, worker, self.workers, self.batch_size, stop,
+                  self.__tried, results),
+            daemon=True) for worker in range(self.workers)]
+        for process in processes:
+            process.start()
+        proof = None
+        try:
+            while not self.__cancelled.is_set():
+                try:
+                    proof = results.get(timeout=0.05)
+                    break
+                except queue.Empty:
+                    continue
+        finally:
+            stop.set()
+            for process in processes:
+                process.join()
+        return proof
@@ -1,10 +1,49 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import (Flask, Response, jsonify, request,
+                   send_from_directory)
 from flask_cors import CORS
-from wallet import Wallet
+from wallet import KEY_TYPE_RSA, KEY_TYPES, Wallet
 from blockchain import Blockchain
+from mempool import EVICT_OLDEST, REJECT_NEW, Mempool
+from miner import Miner
+from utility import codec, metrics
+from utility.broadcast import QUORUM_NONE, QUORUMS, Broadcaster
+from utility.difficulty import Difficulty
+from utility.gossip import Gossip, SeenFilter
+from utility.peers import PeerHealth
+from utility.jobs import JobQueue
 
 app = Flask(__name__)
 CORS(app)
+# Blocks are mined one after the other on a background thread.
+mining_jobs = JobQueue(progress=lambda: blockchain.miner.progress())
+
+
+def get_request_values():
+    """ Returns the json or binary payload of the request.
+
+    Binary payloads which are malformed or not a dict give None.
+    """
+    if request.mimetype != codec.BINARY_MIMETYPE:
+        return request.get_json()
+    try:
+        data = request.get_data()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            data = codec.decompress(data)
+        values = codec.decode(data)
+    except ValueError:
+        return None
+    return values if isinstance(values, dict) else None
+
+
+def wants_binary():
+    """ Returns whether the client prefers the binary wire format. """
+    return request.accept_mimetypes.best_match(
+        ['application/json', codec.BINARY_MIMETYPE]) == codec.BINARY_MIMETYPE
+
+
+def accepts_gzip():
+    """ Returns whether the client accepts gzipped responses. """
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
 
 
 @app.route('/', methods=['GET'])
@@ -19,12 +58,54 @@ def get_network_ui():
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_snapshot = blockchain.get_chain()
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
-    for dict_block in dict_chain:
-        dict_block['transactions'] = [
-            tx.__dict__ for tx in dict_block['transactions']]
-    return jsonify(dict_chain), 200
+    start = request.args.get('from', 0, type=int)
+    end = request.args.get('to', None, type=int)
+    binary = wants_binary()
+    # Binary chains are gzipped for the clients accepting it.
+    compressed = binary and accepts_gzip()
+    # The chain only changes with its tip, so the tip hash identifies every
+    # range of it. Unchanged chains are answered without a body.
+    etag = '{}-{}'.format(blockchain.get_chain_tip()['hash'],
+                          'binary-gzip' if compressed
+                          else 'binary' if binary else 'json')
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        body = blockchain.get_serialized_chain(binary, start, end)
+        response = Response(
+            codec.compress(body) if compressed else body, status=200,
+            mimetype=codec.BINARY_MIMETYPE if binary else 'application/json')
+        if compressed:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/chain/tip', methods=['GET'])
+def get_chain_tip():
+    return jsonify(blockchain.get_chain_tip()), 200
+
+
+@app.route('/chain/headers', methods=['GET'])
+def get_chain_headers():
+    start = request.args.get('from', 0, type=int)
+    end = request.args.get('to', None, type=int)
+    return jsonify(blockchain.get_chain_headers(start, end)), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.ENABLED:
+        response = {
+            'message': 'Metrics are disabled, start the node with --metrics.'
+        }
+        return jsonify(response), 404
+    metrics.MEMPOOL_SIZE.set(len(blockchain.get_open_transactions()))
+    metrics.CHAIN_HEIGHT.set(blockchain.get_last_blockchain().index)
+    return Response(metrics.render(), status=200,
+                    mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/mine', methods=['POST'])
@@ -34,23 +115,35 @@ def mine():
             'message': 'Resolve conflicts first, block not added!'
         }
         return jsonify(response), 409
+    job = mining_jobs.submit(mine_block)
+    response = {
+        'message': 'Mining job queued.',
+        'job': job
+    }
+    return jsonify(response), 202, {'Location': '/mine/{}'.format(job['id'])}
+
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    job = mining_jobs.status(job_id)
+    if job is None:
+        response = {'message': 'Mining job not found.'}
+        return jsonify(response), 404
+    return jsonify(job), 200
+
+
+def mine_block():
+    """ Runs a mining job on the worker thread of mining_jobs. """
+    if blockchain.resolve_conflicts:
+        return False, {'message': 'Resolve conflicts first, block not added!'}
     block = blockchain.mine_block()
-    if block is not None:
-        dict_block = block.__dict__.copy()
-        dict_block['transactions'] = [
-            tx.__dict__ for tx in dict_block['transactions']]
-        response = {
-            'message': 'Block was added successfuly.',
-            'block': dict_block,
-            'funds': blockchain.get_balance()
-        }
-        return jsonify(response), 201
-    else:
-        response = {
-            'message': 'Adding a block failed.',
-            'wallet_set_up': wallet.public_key is not None
-        }
-        return jsonify(response), 500
+    if block is None:
+        return False, {'message': 'Adding a block failed.',
+                       'wallet_set_up': wallet.public_key is not None}
+    return True, {'message': 'Block was added successfuly.',
+                  'block': block.to_dict(),
+                  'funds': blockchain.get_balance(),
+                  'mining': blockchain.miner.last_stats}
 
 
 @app.route('/transaction', methods=['POST'])
@@ -96,19 +189,76 @@ def add_transaction():
         return jsonify(response), 500
 
 
+@app.route('/transactions/batch', methods=['POST'])
+def add_transactions():
+    return add_transaction_batch(False)
+
+
+@app.route('/broadcast-transactions', methods=['POST'])
+def broadcast_transactions():
+    return add_transaction_batch(True)
+
+
+def add_transaction_batch(is_recieving):
+    values = get_request_values()
+    if not values or not isinstance(values.get('transactions'), list):
+        response = {
+            'message': 'No transactions found.'
+        }
+        return jsonify(response), 400
+    required = ['sender', 'recipient', 'amount', 'signature']
+    if not all(isinstance(tx, dict) and all(key in tx for key in required)
+               for tx in values['transactions']):
+        response = {
+            'message': 'Some fields are missing.'
+        }
+        return jsonify(response), 400
+    results, broadcasted = blockchain.add_transactions(
+        values['transactions'], is_recieving)
+    accepted = results.count(True)
+    response = {
+        'message': 'Added {} of {} transactions'.format(accepted,
+                                                        len(results)),
+        'accepted': accepted,
+        'rejected': [index for index, added in enumerate(results)
+                     if not added],
+        'broadcasted': broadcasted
+    }
+    if accepted == 0 and results:
+        return jsonify(response), 500
+    return jsonify(response), 200
+
+
 @app.route('/transactions', methods=['GET'])
 def get_open_transactions():
     transactions = blockchain.get_open_transactions()
-    dict_transactions = [tx.__dict__ for tx in transactions]
+    dict_transactions = [tx.to_dict() for tx in transactions]
     return jsonify(dict_transactions), 200
 
 
+@app.route('/tx/<tx_id>/proof', methods=['GET'])
+def get_transaction_proof(tx_id):
+    proof = blockchain.get_transaction_proof(tx_id)
+    if proof is None:
+        response = {'message': 'Transaction not found in the chain.'}
+        return jsonify(response), 404
+    return jsonify(proof), 200
+
+
+@app.route('/address/<address>/transactions', methods=['GET'])
+def get_address_transactions(address):
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    return jsonify(blockchain.get_address_transactions(address, offset,
+                                                       limit)), 200
+
+
 @app.route('/wallet', methods=['POST'])
 def create_keys():
     wallet.create_keys()
     if wallet.save_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # Requests and the mining worker keep using the same Blockchain.
+        blockchain.public_key = wallet.public_key
         response = {
             'private_key': wallet.private_key,
             'public_key': wallet.public_key,
@@ -125,8 +275,8 @@ def create_keys():
 @app.route('/wallet', methods=['GET'])
 def load_keys():
     if wallet.load_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # Requests and the mining worker keep using the same Blockchain.
+        blockchain.public_key = wallet.public_key
         response = {
             'private_key': wallet.private_key,
             'public_key': wallet.public_key,
@@ -199,14 +349,15 @@ def remove_node(node_url):
 def get_nodes():
     nodes = blockchain.get_peer_nodes()
     response = {
-        'all_nodes': nodes
+        'all_nodes': nodes,
+        'health': blockchain.broadcaster.health.scores(nodes)
     }
     return jsonify(response), 200
 
 
 @app.route('/broadcast-transaction', methods=['POST'])
 def broadcast_transaction():
-    values = request.get_json()
+    values = get_request_values()
     if not values:
         response = {
             'message': 'No data attached.'
@@ -243,7 +394,7 @@ def broadcast_transaction():
 
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    values = request.get_json()
+    values = get_request_values()
     if not values:
         response = {
             'message': 'No data attached.'
@@ -255,31 +406,52 @@ def broadcast_block():
         }
         return jsonify(response), 400
     block = values['block']
-    chain = blockchain.get_chain()
-    if block['index'] == chain[-1].index + 1:
-        if blockchain.add_block(block):
+    if blockchain.has_block(block.get('hash')):
+        response = {
+            'message': 'Block is already known.'
+        }
+        return jsonify(response), 200
+    last_block = blockchain.get_last_blockchain()
+    if block['index'] > last_block.index + 1:
+        response = {
+            'message': 'Blockchain seems to differ from local blockchain'
+        }
+        blockchain.resolve_conflicts = True
+        metrics.CONFLICTS_TOTAL.inc(source='broadcast_block')
+        # Gossiped blocks are missed now and then, nobody else would
+        # resolve for this node.
+        if blockchain.gossip is not None:
+            blockchain.catch_up()
+        return jsonify(response), 200
+    # Gossip delivers blocks more than once, a copy may have been added
+    # since has_block was asked.
+    if block['index'] == last_block.index + 1:
+        added = blockchain.add_block(block)
+        if added:
             print("add_block come with TRUE")
             response = {
                 'message': 'Block has been successfully added.'
             }
             return jsonify(response), 201
-        else:
+        if added is None:
             response = {
-                'message': 'Block seems to be incorrect.'
+                'message': 'Block is already known.'
             }
-            return jsonify(response), 409
-    elif block['index'] > chain[-1].index:
+            return jsonify(response), 200
         response = {
-            'message': 'Blockchain seems to differ from local blockchain'
+            'message': 'Block seems to be incorrect.'
         }
-        blockchain.resolve_conflicts = True
-        return jsonify(response), 200
-    else:
+        return jsonify(response), 409
+    if blockchain.has_block(block.get('hash')):
         response = {
-            'message': 'Blockchain seems to be shorted, \
-            some blocks are not added.'
+            'message': 'Block is already known.'
         }
-        return jsonify(response), 409
+        return jsonify(response), 200
+    response = {
+        'message': 'Blockchain seems to be shorted, \
+        some blocks are not added.'
+    }
+    return jsonify(response), 409
 
 
 @app.route('/resolve-conflicts', methods=['POST'])
@@ -300,8 +472,57 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('--mining-workers', type=int, default=None)
+    parser.add_argument('--mining-batch-size', type=int, default=None)
+    parser.add_argument('--mempool-size', type=int, default=None)
+    parser.add_argument('--mempool-eviction', default=EVICT_OLDEST,
+                        choices=[EVICT_OLDEST, REJECT_NEW])
+    parser.add_argument('--broadcast-workers', type=int, default=None)
+    parser.add_argument('--broadcast-timeout', type=float, default=None)
+    parser.add_argument('--broadcast-quorum', default=QUORUM_NONE,
+                        choices=QUORUMS)
+    parser.add_argument('--peer-failure-threshold', type=int, default=None,
+                        help='failures in a row after which a peer is '
+                             'skipped with exponential backoff')
+    parser.add_argument('--peer-backoff-max', type=float, default=None,
+                        help='longest backoff of a failing peer, in seconds')
+    parser.add_argument('--wire-format', default='json',
+                        choices=['json', 'binary'])
+    parser.add_argument('--wire-compression', action='store_true')
+    parser.add_argument('--metrics', action='store_true')
+    parser.add_argument('--key-type', default=KEY_TYPE_RSA, choices=KEY_TYPES,
+                        help='type of the keys created by POST /wallet')
+    parser.add_argument('--gossip-fanout', type=int, default=None,
+                        help='relay messages to this many random peers '
+                             'instead of sending them to every peer')
+    parser.add_argument('--gossip-seen-capacity', type=int, default=None)
+    parser.add_argument('--block-interval', type=float, default=None,
+                        help='seconds between blocks the difficulty is '
+                             'retargeted for, the same on every node')
+    parser.add_argument('--retarget-interval', type=int, default=None,
+                        help='blocks between difficulty retargets')
+    parser.add_argument('--max-future-drift', type=float, default=None,
+                        help='seconds a block timestamp may be ahead of '
+                             'the local clock')
     args = parser.parse_args()
     port = args.port
-    wallet = Wallet(port)
-    blockchain = Blockchain(wallet.public_key, port)
+    if args.metrics:
+        metrics.enable()
+    miner = Miner(args.mining_workers, args.mining_batch_size)
+    mempool = Mempool(args.mempool_size, args.mempool_eviction)
+    broadcaster = Broadcaster(args.broadcast_workers, args.broadcast_timeout,
+                              args.broadcast_quorum,
+                              args.wire_format == 'binary',
+                              args.wire_compression,
+                              PeerHealth(args.peer_failure_threshold,
+                                         backoff_max=args.peer_backoff_max))
+    gossip = None
+    if args.gossip_fanout:
+        gossip = Gossip(args.gossip_fanout,
+                        SeenFilter(args.gossip_seen_capacity))
+    wallet = Wallet(port, args.key_type)
+    difficulty = Difficulty(args.block_interval, args.retarget_interval,
+                            args.max_future_drift)
+    blockchain = Blockchain(wallet.public_key, port, miner, mempool,
+                            broadcaster, gossip, difficulty)
     app.run(host='0.0.0.0', port=port)
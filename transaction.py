@@ -1,8 +1,11 @@
 from collections import OrderedDict
+from utility.hash_util import hash_string_256
 from utility.printable import Printable
 
 
 class Transaction(Printable):
+    __slots__ = ('sender', 'recipient', 'amount', 'signature')
+
     def __init__(self, sender, recipient, signature, amount):
         self.sender = sender
         self.recipient = recipient
@@ -14,3 +17,31 @@ class Transaction(Printable):
                             ('recipient', self.recipient),
                             ('signature', self.signature),
                             ('amount', self.amount)])
+
+    def to_dict(self):
+        """ Returns the dict the transaction is stored and sent as. """
+        return {'sender': self.sender,
+                'recipient': self.recipient,
+                'amount': self.amount,
+                'signature': self.signature}
+
+    @classmethod
+    def from_dict(cls, tx):
+        return cls(tx['sender'], tx['recipient'], tx['signature'],
+                   tx['amount'])
+
+    @classmethod
+    def reward(cls, recipient, height, amount):
+        """ Returns the mining reward of the block at the height.
+
+        Rewards aren't signed, the height takes the place of the signature
+        so the rewards of different blocks to one miner get distinct ids.
+        """
+        return cls('MINING', recipient, str(height), amount)
+
+    @property
+    def tx_id(self):
+        """ Returns the digest of the signed payload of the transaction. """
+        return hash_string_256((str(self.sender) + str(self.recipient) +
+                                str(self.amount) +
+                                str(self.signature)).encode('utf8'))
@@ -0,0 +1,163 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+
+import requests
+
+from utility import codec, metrics
+from utility.peers import PeerHealth
+
+BROADCAST_WORKERS = 16
+BROADCAST_TIMEOUT = 2.0
+QUORUM_NONE = 'none'
+QUORUM_ONE = 'one'
+QUORUM_MAJORITY = 'majority'
+QUORUM_ALL = 'all'
+QUORUMS = [QUORUM_NONE, QUORUM_ONE, QUORUM_MAJORITY, QUORUM_ALL]
+
+
+class Broadcaster:
+    """ Sends requests to the peer nodes concurrently.
+
+    Requests run on a bounded thread pool, with one keep-alive session per
+    peer and a timeout on every request. A broadcast only waits until the
+    quorum of peers acknowledged it, the rest completes in the background.
+    Payloads go out as json, or in the binary wire format (optionally
+    gzipped) when binary is set. Every request updates the health record
+    of its peer, peers whose circuit is open are skipped by broadcasts.
+    """
+
+    def __init__(self, workers=None, timeout=None, quorum=QUORUM_NONE,
+                 binary=False, compress=False, health=None):
+        if quorum not in QUORUMS:
+            raise ValueError('Unknown quorum {}'.format(quorum))
+        self.timeout = BROADCAST_TIMEOUT if timeout is None else timeout
+        self.quorum = quorum
+        self.binary = binary
+        self.compress = compress
+        self.health = PeerHealth() if health is None else health
+        self.__executor = ThreadPoolExecutor(
+            max_workers=BROADCAST_WORKERS if workers is None else workers)
+        self.__sessions = {}
+        self.__sessions_lock = threading.Lock()
+
+    def session(self, peer):
+        """ Returns the keep-alive session of the given peer. """
+        with self.__sessions_lock:
+            session = self.__sessions.get(peer)
+            if session is None:
+                session = requests.Session()
+                self.__sessions[peer] = session
+            return session
+
+    def drop_session(self, peer):
+        """ Closes the session and forgets the health of a peer which was
+        removed.
+        """
+        with self.__sessions_lock:
+            session = self.__sessions.pop(peer, None)
+        if session is not None:
+            session.close()
+        self.health.forget(peer)
+
+    def get(self, peer, path, **kwargs):
+        """ Sends a GET request to the peer, raises on connection errors. """
+        started = perf_counter()
+        try:
+            response = self.session(peer).get(
+                'http://{}{}'.format(peer, path), timeout=self.timeout,
+                **kwargs)
+        except requests.exceptions.RequestException:
+            self.health.record_failure(peer)
+            raise
+        self.health.record_success(peer, perf_counter() - started)
+        return response
+
+    def fetch(self, peer, path, params=None):
+        """ Returns the decoded json or binary message the peer answers
+        a GET request with, raises ValueError on malformed answers.
+        """
+        headers = {}
+        if self.binary:
+            headers['Accept'] = '{}, application/json;q=0.5'.format(
+                codec.BINARY_MIMETYPE)
+        response = self.get(peer, path, params=params, headers=headers)
+        if response.headers.get('Content-Type', '').startswith(
+                codec.BINARY_MIMETYPE):
+            return codec.decode(response.content)
+        return response.json()
+
+    def encode(self, payload):
+        """ Returns the body and headers a payload is posted with. """
+        if not self.binary:
+            return None, {}
+        body = codec.encode(payload)
+        headers = {'Content-Type': codec.BINARY_MIMETYPE}
+        if self.compress:
+            body = codec.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    def required_acks(self, peer_count, quorum=None):
+        """ Returns how many peers have to acknowledge a broadcast. """
+        quorum = self.quorum if quorum is None else quorum
+        if quorum == QUORUM_ONE:
+            return min(1, peer_count)
+        if quorum == QUORUM_MAJORITY:
+            return peer_count // 2 + 1 if peer_count else 0
+        if quorum == QUORUM_ALL:
+            return peer_count
+        return 0
+
+    def broadcast(self, peers, path, payload, on_response=None,
+                  quorum=None):
+        """ Posts the payload to the peers, returns whether the quorum
+        acknowledged it. Peers with an open circuit count as failed.
+
+        Arguments:
+            :peers: The peer nodes the payload is sent to.
+            :path: The path of the endpoint, e.g. /broadcast-block.
+            :payload: The json payload.
+            :on_response: Called with the peer and the response (None on
+                          connection errors) of every request.
+            :quorum: The quorum of this broadcast (default the quorum of
+                     the broadcaster).
+        """
+        peers = list(peers)
+        required = self.required_acks(len(peers), quorum)
+        available = self.health.available(peers)
+        body, headers = self.encode(payload)
+        if body is not None:
+            payload = None
+        pending = {self.__executor.submit(self.__post, peer, path, payload,
+                                          body, headers, on_response)
+                   for peer in available}
+        acks = 0
+        failures = len(peers) - len(available)
+        while acks < required and len(peers) - failures >= required:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.result():
+                    acks += 1
+                else:
+                    failures += 1
+        return acks >= required
+
+    def __post(self, peer, path, payload, body, headers, on_response):
+        url = 'http://{}{}'.format(peer, path)
+        started = perf_counter()
+        try:
+            with metrics.BROADCAST_SECONDS.time(peer=peer):
+                response = self.session(peer).post(
+                    url, json=payload, data=body, headers=headers,
+                    timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            print('Broadcast to {} failed'.format(peer))
+            metrics.BROADCAST_FAILURES.inc(peer=peer)
+            self.health.record_failure(peer)
+            response = None
+        else:
+            self.health.record_success(peer, perf_counter() - started)
+        if on_response is not None:
+            on_response(peer, response)
+        return response is not None and 200 <= response.status_code < 300
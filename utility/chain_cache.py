@@ -0,0 +1,89 @@
+import threading
+
+# The number of blocks at the tip whose encoding is kept.
+CACHE_WINDOW = 256
+
+
+class SerializedChain:
+    """ A serialization of the tail of the chain, extended as blocks are
+    appended.
+
+    The encoded blocks of the last window heights are kept back to back
+    with the offset of every block, so a response for a range near the tip,
+    like the suffix a syncing peer asks for, is one slice of the cache.
+    Blocks missing at the end are encoded on the next request, blocks before
+    the window are encoded for every request which includes them. The cache
+    grows to twice the window before the oldest blocks are dropped, a
+    replaced chain truncates it at the height where it changed.
+    """
+
+    def __init__(self, encode_block, frame, window=None):
+        """
+        Arguments:
+            :encode_block: Returns the bytes of the block at a height.
+            :frame: Returns the response of the encoded blocks and their
+                    count.
+            :window: The number of blocks at the tip which are kept.
+        """
+        self.__encode_block = encode_block
+        self.__frame = frame
+        self.window = CACHE_WINDOW if window is None else max(1, window)
+        # The height of the first cached block.
+        self.__base = 0
+        self.__data = bytearray()
+        self.__offsets = [0]
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """ Returns the height after the last cached block. """
+        return self.__base + len(self.__offsets) - 1
+
+    def truncate(self, height):
+        """ Drops the encoded blocks from the given height on. """
+        with self.__lock:
+            if height <= self.__base:
+                self.__clear(height)
+            elif height < len(self):
+                position = height - self.__base
+                del self.__data[self.__offsets[position]:]
+                del self.__offsets[position + 1:]
+
+    def serialize(self, length, start=0, end=None):
+        """ Returns the response for the blocks in [start, end).
+
+        Arguments:
+            :length: The current length of the chain.
+            :start: The height of the first block.
+            :end: The height after the last block.
+        """
+        with self.__lock:
+            self.__extend(length)
+            start, end, _ = slice(start, end).indices(length)
+            end = max(start, end)
+            head = b''.join(self.__encode_block(height) for height
+                            in range(start, min(end, self.__base)))
+            first = max(start, self.__base) - self.__base
+            last = max(end, self.__base) - self.__base
+            return self.__frame(
+                head + self.__data[self.__offsets[first]:self.__offsets[last]],
+                end - start)
+
+    def __extend(self, length):
+        """ Encodes the blocks up to length, keeping the window. """
+        if length - len(self) > self.window:
+            self.__clear(length - self.window)
+        while len(self) < length:
+            self.__data += self.__encode_block(len(self))
+            self.__offsets.append(len(self.__data))
+        excess = len(self.__offsets) - 1 - self.window
+        if excess > self.window:
+            cut = self.__offsets[excess]
+            del self.__data[:cut]
+            self.__offsets = [offset - cut
+                              for offset in self.__offsets[excess:]]
+            self.__base += excess
+
+    def __clear(self, base):
+        self.__base = base
+        self.__data = bytearray()
+        self.__offsets = [0]
@@ -0,0 +1,231 @@
+import binascii
+import gzip
+import struct
+
+BINARY_MIMETYPE = 'application/x-blockchain'
+
+CHAIN = b'C'
+BLOCK = b'B'
+TRANSACTION = b'T'
+TRANSACTIONS = b'L'
+
+_TEXT = 0
+_HEX = 1
+_NONE = 2
+_INT = b'i'
+_FLOAT = b'f'
+
+_LENGTH = struct.Struct('>I')
+_INT_VALUE = struct.Struct('>q')
+_FLOAT_VALUE = struct.Struct('>d')
+
+
+def encode(message):
+    """ Returns the binary encoding of a chain, block or transaction message.
+
+    Public keys and signatures are carried as raw bytes instead of hex and
+    numbers keep their int or float type, since it is part of the signed
+    and hashed payloads. decode returns the same dicts and lists the json
+    endpoints use.
+
+    Arguments:
+        :message: A list of block dicts, {'block': ...}, {'transactions':
+                  [...]} or a transaction dict.
+    """
+    out = bytearray()
+    try:
+        if isinstance(message, list):
+            out += CHAIN
+            _write_blocks(out, message)
+        elif 'block' in message:
+            out += BLOCK
+            _write_block(out, message['block'])
+        elif 'transactions' in message:
+            out += TRANSACTIONS
+            _write_transactions(out, message['transactions'])
+        else:
+            out += TRANSACTION
+            _write_transaction(out, message)
+    except struct.error as error:
+        raise ValueError('Value out of range: {}'.format(error))
+    return bytes(out)
+
+
+def decode(data):
+    """ Returns the message of a binary encoding, raises ValueError. """
+    try:
+        reader = _Reader(data)
+        kind = reader.take(1)
+        if kind == CHAIN:
+            message = _read_blocks(reader)
+        elif kind == BLOCK:
+            message = {'block': _read_block(reader)}
+        elif kind == TRANSACTIONS:
+            message = {'transactions': _read_transactions(reader)}
+        elif kind == TRANSACTION:
+            message = _read_transaction(reader)
+        else:
+            raise ValueError('Unknown message kind {}'.format(kind))
+        if reader.offset != len(data):
+            raise ValueError('Trailing bytes after the message')
+        return message
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise ValueError('Malformed message: {}'.format(error))
+
+
+def encode_block(block):
+    """ Returns the encoding of a block dict inside a chain message. """
+    out = bytearray()
+    try:
+        _write_block(out, block)
+    except struct.error as error:
+        raise ValueError('Value out of range: {}'.format(error))
+    return bytes(out)
+
+
+def frame_chain(encoded_blocks, count):
+    """ Returns the chain message of count blocks from encode_block. """
+    return CHAIN + _LENGTH.pack(count) + encoded_blocks
+
+
+def compress(data):
+    return gzip.compress(data)
+
+
+def decompress(data):
+    try:
+        return gzip.decompress(data)
+    except (OSError, EOFError) as error:
+        raise ValueError('Malformed compressed message: {}'.format(error))
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def take(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError('Truncated message')
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    def unpack(self, layout):
+        return layout.unpack(self.take(layout.size))[0]
+
+
+def _write_string(out, value):
+    """ Writes a string, as raw bytes when it is lowercase hex. """
+    if value is None:
+        out.append(_NONE)
+        return
+    if not isinstance(value, str):
+        raise ValueError('Unsupported string {!r}'.format(value))
+    try:
+        raw = binascii.unhexlify(value)
+        if binascii.hexlify(raw).decode('ascii') != value:
+            raise ValueError()
+        out.append(_HEX)
+    except (ValueError, binascii.Error):
+        raw = value.encode('utf8')
+        out.append(_TEXT)
+    out += _LENGTH.pack(len(raw))
+    out += raw
+
+
+def _read_string(reader):
+    flag = reader.take(1)[0]
+    if flag == _NONE:
+        return None
+    raw = reader.take(reader.unpack(_LENGTH))
+    if flag == _HEX:
+        return binascii.hexlify(raw).decode('ascii')
+    if flag == _TEXT:
+        return raw.decode('utf8')
+    raise ValueError('Unknown string flag {}'.format(flag))
+
+
+def _write_number(out, value):
+    # bool is an int, but str(True) would change the signed payload.
+    if isinstance(value, int) and not isinstance(value, bool):
+        out += _INT
+        out += _INT_VALUE.pack(value)
+    elif isinstance(value, float):
+        out += _FLOAT
+        out += _FLOAT_VALUE.pack(value)
+    else:
+        raise ValueError('Unsupported number {!r}'.format(value))
+
+
+def _read_number(reader):
+    tag = reader.take(1)
+    if tag == _INT:
+        return reader.unpack(_INT_VALUE)
+    if tag == _FLOAT:
+        return reader.unpack(_FLOAT_VALUE)
+    raise ValueError('Unknown number tag {}'.format(tag))
+
+
+def _write_transaction(out, tx):
+    _write_string(out, tx['sender'])
+    _write_string(out, tx['recipient'])
+    _write_string(out, tx['signature'])
+    _write_number(out, tx['amount'])
+
+
+def _read_transaction(reader):
+    return {'sender': _read_string(reader),
+            'recipient': _read_string(reader),
+            'signature': _read_string(reader),
+            'amount': _read_number(reader)}
+
+
+def _write_transactions(out, transactions):
+    out += _LENGTH.pack(len(transactions))
+    for tx in transactions:
+        _write_transaction(out, tx)
+
+
+def _read_transactions(reader):
+    return [_read_transaction(reader)
+            for _ in range(reader.unpack(_LENGTH))]
+
+
+def _write_block(out, block):
+    _write_number(out, block['index'])
+    _write_string(out, block['previous_hash'])
+    _write_string(out, block.get('hash'))
+    _write_string(out, block.get('merkle_root'))
+    _write_string(out, block.get('target'))
+    _write_number(out, block['proof'])
+    _write_number(out, block['timestamp'])
+    _write_transactions(out, block['transactions'])
+
+
+def _read_block(reader):
+    block = {'index': _read_number(reader),
+             'previous_hash': _read_string(reader)}
+    block_hash = _read_string(reader)
+    if block_hash is not None:
+        block['hash'] = block_hash
+    root = _read_string(reader)
+    if root is not None:
+        block['merkle_root'] = root
+    target = _read_string(reader)
+    if target is not None:
+        block['target'] = target
+    block['proof'] = _read_number(reader)
+    block['timestamp'] = _read_number(reader)
+    block['transactions'] = _read_transactions(reader)
+    return block
+
+
+def _write_blocks(out, blocks):
+    out += _LENGTH.pack(len(blocks))
+    for block in blocks:
+        _write_block(out, block)
+
+
+def _read_blocks(reader):
+    return [_read_block(reader) for _ in range(reader.unpack(_LENGTH))]
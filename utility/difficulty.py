@@ -0,0 +1,111 @@
+from time import time
+
+# A block hash below the target, read as a big endian number, is a valid
+# proof of work. The genesis target accepts digests starting with a zero
+# byte, like the former '00' hex prefix.
+INITIAL_TARGET = 2 ** 248
+MAX_TARGET = 2 ** 255
+BLOCK_INTERVAL = 10.0
+RETARGET_INTERVAL = 10
+# The target changes by at most this factor at every retarget.
+MAX_ADJUSTMENT = 4
+# A block must be later than the median timestamp of this many blocks
+# before it, and at most MAX_FUTURE_DRIFT seconds ahead of the local clock.
+MEDIAN_TIME_BLOCKS = 11
+MAX_FUTURE_DRIFT = 120.0
+
+
+def target_hex(target):
+    """ Returns the 64 hex digit encoding a block carries its target in. """
+    return '{:064x}'.format(target)
+
+
+def target_bytes(target):
+    """ Returns the 32 big endian bytes the digests are compared with, raises
+    ValueError on malformed targets.
+
+    Arguments:
+        :target: The hex encoded target of a block.
+    """
+    try:
+        raw = bytes.fromhex(target)
+    except TypeError as error:
+        raise ValueError('Malformed target: {}'.format(error))
+    if len(raw) != 32:
+        raise ValueError('Targets must be 32 bytes')
+    return raw
+
+
+class Difficulty:
+    """ The retargeting rule of the proof of work.
+
+    Every block carries the target its hash must be below. It is the target
+    of the previous block, except every retarget_interval blocks: then it is
+    scaled by how long the last interval took compared to block_interval
+    seconds per block, by at most MAX_ADJUSTMENT either way. All the nodes
+    of a network must use the same settings.
+
+    Since the timestamps are chosen by the miners, they are bounded: a
+    block must be later than the median of the MEDIAN_TIME_BLOCKS blocks
+    before it and at most max_future_drift seconds ahead of the local clock.
+    """
+
+    def __init__(self, block_interval=None, retarget_interval=None,
+                 max_future_drift=None):
+        self.block_interval = (BLOCK_INTERVAL if block_interval is None
+                               else block_interval)
+        self.retarget_interval = (RETARGET_INTERVAL
+                                  if retarget_interval is None
+                                  else max(2, retarget_interval))
+        self.max_future_drift = (MAX_FUTURE_DRIFT if max_future_drift is None
+                                 else max_future_drift)
+
+    def next_target(self, height, block_at):
+        """ Returns the target of the block at the height.
+
+        Arguments:
+            :height: The index of the block.
+            :block_at: Returns the block at a lower height.
+        """
+        if height <= 1:
+            return INITIAL_TARGET
+        previous = block_at(height - 1)
+        target = int(previous.target, 16)
+        # The genesis timestamp is fixed, it never starts an interval.
+        if (height % self.retarget_interval or
+                height <= self.retarget_interval):
+            return target
+        first = block_at(height - self.retarget_interval)
+        # Whole milliseconds keep the result the same on every node.
+        elapsed = round((previous.timestamp - first.timestamp) * 1000)
+        expected = max(1, round(self.block_interval *
+                                (self.retarget_interval - 1) * 1000))
+        elapsed = min(max(elapsed, expected // MAX_ADJUSTMENT),
+                      expected * MAX_ADJUSTMENT)
+        return max(1, min(MAX_TARGET, target * elapsed // expected))
+
+    def median_time(self, height, block_at):
+        """ Returns the median timestamp of the MEDIAN_TIME_BLOCKS blocks
+        before the height, the block at the height must be later.
+
+        Arguments:
+            :height: The index of the block, at least 1.
+            :block_at: Returns the block at a lower height.
+        """
+        timestamps = sorted(block_at(previous).timestamp for previous in
+                            range(max(0, height - MEDIAN_TIME_BLOCKS), height))
+        return timestamps[len(timestamps) // 2]
+
+    def valid_timestamp(self, height, timestamp, block_at):
+        """ Returns whether the timestamp of the block at the height is later
+        than the median time and not too far ahead of the local clock.
+
+        Arguments:
+            :height: The index of the block.
+            :timestamp: The timestamp of the block.
+            :block_at: Returns the block at a lower height.
+        """
+        if height <= 0:
+            return True
+        return (self.median_time(height, block_at) < timestamp <=
+                time() + self.max_future_drift)
@@ -0,0 +1,93 @@
+import hashlib
+import math
+import random
+import threading
+
+GOSSIP_FANOUT = 8
+SEEN_CAPACITY = 100000
+SEEN_ERROR_RATE = 0.001
+
+
+class BloomFilter:
+    """ A set of strings which can answer false positives but never false
+    negatives, kept in a fixed number of bits.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) /
+                               math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self.__bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, item):
+        # Double hashing on the two halves of one sha256 digest.
+        digest = hashlib.sha256(item.encode('utf8')).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:16], 'big') | 1
+        return [(first + index * second) % self.size
+                for index in range(self.hashes)]
+
+    def __contains__(self, item):
+        return all(self.__bits[position >> 3] & (1 << (position & 7))
+                   for position in self.__positions(item))
+
+    def add(self, item):
+        for position in self.__positions(item):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class SeenFilter:
+    """ Remembers the ids of the recently seen messages in two rotating
+    Bloom filters.
+
+    New ids go into the current filter. When it holds capacity ids it
+    becomes the previous one and an empty filter takes its place, so the
+    last capacity to 2 * capacity ids are remembered in constant memory.
+    """
+
+    def __init__(self, capacity=None, error_rate=None):
+        self.capacity = SEEN_CAPACITY if capacity is None else capacity
+        self.error_rate = (SEEN_ERROR_RATE if error_rate is None
+                           else error_rate)
+        self.__current = BloomFilter(self.capacity, self.error_rate)
+        self.__previous = BloomFilter(self.capacity, self.error_rate)
+        self.__lock = threading.Lock()
+
+    def __contains__(self, message_id):
+        with self.__lock:
+            return (message_id in self.__current or
+                    message_id in self.__previous)
+
+    def add(self, message_id):
+        """ Records the id, returns False if it was seen already. """
+        with self.__lock:
+            if (message_id in self.__current or
+                    message_id in self.__previous):
+                return False
+            if self.__current.count >= self.capacity:
+                self.__previous = self.__current
+                self.__current = BloomFilter(self.capacity, self.error_rate)
+            self.__current.add(message_id)
+            return True
+
+
+class Gossip:
+    """ Relays messages to a random subset of the peers.
+
+    Every node forwards a message it sees for the first time to fanout
+    peers, so a message reaches the whole network without its originator
+    contacting every node. Messages seen before are dropped.
+    """
+
+    def __init__(self, fanout=None, seen=None):
+        self.fanout = GOSSIP_FANOUT if fanout is None else max(1, fanout)
+        self.seen = SeenFilter() if seen is None else seen
+
+    def select(self, peers):
+        """ Returns up to fanout peers picked at random. """
+        peers = list(peers)
+        if len(peers) <= self.fanout:
+            return peers
+        return random.sample(peers, self.fanout)
@@ -0,0 +1,94 @@
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from time import time
+
+JOBS_KEPT = 100
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue:
+    """ Runs submitted tasks one after the other on a background thread.
+
+    Every task gets a job id, its status can be polled while it waits,
+    runs and after it finished. Only the last JOBS_KEPT jobs are kept.
+    """
+
+    def __init__(self, progress=None, kept=None):
+        """
+        Arguments:
+            :progress: Returns a dict describing the progress of the running
+                       task, or None.
+            :kept: How many jobs are kept for polling.
+        """
+        self.__progress = progress
+        self.__kept = JOBS_KEPT if kept is None else kept
+        self.__jobs = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__queue = queue.Queue()
+        self.__worker = None
+
+    def submit(self, task):
+        """ Queues the task and returns the status of its job.
+
+        Arguments:
+            :task: Called without arguments on the worker thread, returns
+                   whether it succeeded and a dict with its result.
+        """
+        job = {'id': uuid.uuid4().hex, 'status': QUEUED,
+               'submitted': time(), 'started': None, 'finished': None,
+               'result': None}
+        with self.__lock:
+            self.__jobs[job['id']] = job
+            while len(self.__jobs) > self.__kept:
+                self.__jobs.popitem(last=False)
+            if self.__worker is None:
+                self.__worker = threading.Thread(target=self.__work,
+                                                 daemon=True)
+                self.__worker.start()
+        self.__queue.put((job['id'], task))
+        return self.status(job['id'])
+
+    def status(self, job_id):
+        """ Returns a copy of the job with its queue position or progress,
+        None for unknown jobs.
+        """
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+            if job['status'] == QUEUED:
+                # The jobs are ordered like the queue.
+                position = 0
+                for other_id, other in self.__jobs.items():
+                    position += other['status'] == QUEUED
+                    if other_id == job_id:
+                        break
+                job['position'] = position
+        if job['status'] == RUNNING and self.__progress is not None:
+            job['progress'] = self.__progress()
+        return job
+
+    def __update(self, job_id, **fields):
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+
+    def __work(self):
+        while True:
+            job_id, task = self.__queue.get()
+            self.__update(job_id, status=RUNNING, started=time())
+            try:
+                succeeded, result = task()
+            except Exception as error:
+                print('Job {} failed: {}'.format(job_id, error))
+                succeeded, result = False, {'message': str(error)}
+            self.__update(job_id, status=DONE if succeeded else FAILED,
+                          finished=time(), result=result)
@@ -0,0 +1,64 @@
+import hashlib
+
+LEFT = 'left'
+RIGHT = 'right'
+
+EMPTY_ROOT = hashlib.sha256(b'').hexdigest()
+
+
+def _hash_pair(left, right):
+    return hashlib.sha256(bytes.fromhex(left) +
+                          bytes.fromhex(right)).hexdigest()
+
+
+def _next_level(level):
+    # An odd node at the end of a level is paired with itself.
+    if len(level) % 2:
+        level = level + [level[-1]]
+    return [_hash_pair(level[position], level[position + 1])
+            for position in range(0, len(level), 2)]
+
+
+def merkle_root(leaves):
+    """ Returns the Merkle root of the hex digests in leaves. """
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves, position):
+    """ Returns the sibling hashes from the leaf at position to the root.
+
+    Every step is {'hash': ..., 'side': 'left' | 'right'}, the side the
+    sibling is concatenated on.
+    """
+    level = list(leaves)
+    proof = []
+    while len(level) > 1:
+        if position % 2:
+            proof.append({'hash': level[position - 1], 'side': LEFT})
+        else:
+            sibling = position + 1 if position + 1 < len(level) else position
+            proof.append({'hash': level[sibling], 'side': RIGHT})
+        level = _next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf, proof, root):
+    """ Returns whether the proof leads from the leaf to the root. """
+    try:
+        current = leaf
+        for step in proof:
+            if step['side'] == LEFT:
+                current = _hash_pair(step['hash'], current)
+            elif step['side'] == RIGHT:
+                current = _hash_pair(current, step['hash'])
+            else:
+                return False
+        return current == root
+    except (KeyError, TypeError, ValueError):
+        return False
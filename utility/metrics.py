@@ -0,0 +1,188 @@
+import threading
+from time import perf_counter
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# Instrumentation is off until enable() is called, every update then
+# returns right away.
+ENABLED = False
+
+_registry = []
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(
+            name, value.replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in pairs) + '}'
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            values = list(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), self._initial())]
+        for key, value in sorted(values):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _initial(self):
+        return 0
+
+    def _render_value(self, key, value):
+        return ['{}{} {}'.format(self.name, self._label_text(key), value)]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _initial(self):
+        return [[0] * len(self.buckets), 0, 0.0]
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts, count, total = self._values.get(key) or self._initial()
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            self._values[key] = [counts, count + 1, total + value]
+
+    def time(self, **labels):
+        """ Returns a context manager observing the seconds it took. """
+        if not ENABLED:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def _render_value(self, key, value):
+        counts, count, total = value
+        lines = ['{}_bucket{} {}'.format(
+            self.name, self._label_text(key, [('le', repr(bound))]),
+            bucket_count) for bound, bucket_count in zip(self.buckets, counts)]
+        lines.append('{}_bucket{} {}'.format(
+            self.name, self._label_text(key, [('le', '+Inf')]), count))
+        lines.append('{}_count{} {}'.format(self.name, self._label_text(key),
+                                            count))
+        lines.append('{}_sum{} {}'.format(self.name, self._label_text(key),
+                                          total))
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(perf_counter() - self.started, **self.labels)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def render():
+    """ Returns all the metrics in the Prometheus text format. """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+MINING_SECONDS = Histogram(
+    'blockchain_mining_seconds', 'Duration of the proof of work searches.')
+MINING_NONCES = Counter(
+    'blockchain_mining_nonces_total', 'Nonces tried by the proof of work.')
+SIGNATURE_VERIFY_SECONDS = Histogram(
+    'blockchain_signature_verify_seconds',
+    'Duration of the signature verifications of a batch.')
+SIGNATURES_VERIFIED = Counter(
+    'blockchain_signatures_verified_total', 'Signatures verified.')
+SAVE_DATA_SECONDS = Histogram(
+    'blockchain_save_data_seconds', 'Duration of save_data.')
+SAVE_DATA_BYTES = Counter(
+    'blockchain_save_data_bytes_total', 'Bytes written by save_data.')
+BROADCAST_SECONDS = Histogram(
+    'blockchain_broadcast_seconds', 'Latency of the requests to the peers.',
+    ['peer'])
+BROADCAST_FAILURES = Counter(
+    'blockchain_broadcast_failures_total',
+    'Requests to the peers which failed to connect or timed out.', ['peer'])
+RESOLVE_SECONDS = Histogram(
+    'blockchain_resolve_seconds', 'Duration of the conflict resolutions.')
+RESOLVE_TOTAL = Counter(
+    'blockchain_resolve_total', 'Conflict resolutions by outcome.',
+    ['outcome'])
+CONFLICTS_TOTAL = Counter(
+    'blockchain_conflicts_total',
+    'Times a peer was found on a different chain, by where it was noticed.',
+    ['source'])
+MEMPOOL_SIZE = Gauge(
+    'blockchain_mempool_size', 'Open transactions in the mempool.')
+CHAIN_HEIGHT = Gauge(
+    'blockchain_chain_height', 'Height of the tip of the chain.')
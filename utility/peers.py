@@ -0,0 +1,131 @@
+import threading
+from time import time
+
+# Weight of the newest sample in the latency average.
+LATENCY_WEIGHT = 0.2
+FAILURE_THRESHOLD = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class PeerHealth:
+    """ Health records of the peers, with a circuit breaker per peer.
+
+    Every request to a peer updates its record: an exponentially weighted
+    average of the latency of its answers, its failures (connection errors
+    and timeouts) and when it last answered. After failure_threshold
+    failures in a row the circuit of the peer opens and it is skipped for a
+    backoff which doubles with every further failure, up to backoff_max
+    seconds. Once the backoff ran out requests go through again (half
+    open); an answer closes the circuit, a failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=None, backoff_base=None,
+                 backoff_max=None):
+        self.failure_threshold = (FAILURE_THRESHOLD
+                                  if failure_threshold is None
+                                  else max(1, failure_threshold))
+        self.backoff_base = (BACKOFF_BASE if backoff_base is None
+                             else backoff_base)
+        self.backoff_max = BACKOFF_MAX if backoff_max is None else backoff_max
+        self.__records = {}
+        self.__lock = threading.Lock()
+
+    def __record(self, peer):
+        record = self.__records.get(peer)
+        if record is None:
+            record = self.__records[peer] = {
+                'latency': None, 'successes': 0, 'failures': 0,
+                'consecutive_failures': 0, 'last_seen': None,
+                'retry_at': 0.0}
+        return record
+
+    def record_success(self, peer, seconds):
+        """ Records an answer of the peer, which closes its circuit.
+
+        Arguments:
+            :peer: The peer node which answered.
+            :seconds: How long the request took.
+        """
+        with self.__lock:
+            record = self.__record(peer)
+            if record['latency'] is None:
+                record['latency'] = seconds
+            else:
+                record['latency'] += LATENCY_WEIGHT * (seconds -
+                                                       record['latency'])
+            record['successes'] += 1
+            record['consecutive_failures'] = 0
+            record['last_seen'] = time()
+            record['retry_at'] = 0.0
+
+    def record_failure(self, peer):
+        """ Records a request to the peer which failed to connect or timed
+        out, opening its circuit after failure_threshold failures in a row.
+        """
+        with self.__lock:
+            record = self.__record(peer)
+            record['failures'] += 1
+            record['consecutive_failures'] += 1
+            excess = (record['consecutive_failures'] -
+                      self.failure_threshold)
+            if excess >= 0:
+                record['retry_at'] = time() + min(
+                    self.backoff_max, self.backoff_base * 2 ** min(excess, 32))
+
+    def forget(self, peer):
+        """ Drops the record of a peer which was removed. """
+        with self.__lock:
+            self.__records.pop(peer, None)
+
+    def __state(self, record, now):
+        if record['consecutive_failures'] < self.failure_threshold:
+            return CLOSED
+        return OPEN if now < record['retry_at'] else HALF_OPEN
+
+    def available(self, peers):
+        """ Returns the peers whose circuit lets requests through, the
+        fastest first and the ones without answers yet last.
+        """
+        now = time()
+        with self.__lock:
+            ranked = []
+            for peer in peers:
+                record = self.__records.get(peer)
+                if record is None:
+                    ranked.append((1, 0.0, peer))
+                elif self.__state(record, now) != OPEN:
+                    latency = record['latency']
+                    ranked.append((latency is None,
+                                   0.0 if latency is None else latency, peer))
+        return [peer for _, _, peer in sorted(ranked)]
+
+    def scores(self, peers):
+        """ Returns the health record and circuit state of every peer. """
+        now = time()
+        scores = {}
+        with self.__lock:
+            for peer in peers:
+                record = self.__records.get(peer)
+                if record is None:
+                    scores[peer] = {'state': CLOSED, 'latency_ms': None,
+                                    'successes': 0, 'failures': 0,
+                                    'consecutive_failures': 0,
+                                    'last_seen': None, 'retry_in': 0.0}
+                    continue
+                latency = record['latency']
+                scores[peer] = {
+                    'state': self.__state(record, now),
+                    'latency_ms': (None if latency is None
+                                   else latency * 1000),
+                    'successes': record['successes'],
+                    'failures': record['failures'],
+                    'consecutive_failures': record['consecutive_failures'],
+                    'last_seen': record['last_seen'],
+                    'retry_in': max(0.0, record['retry_at'] - now)
+                }
+        return scores
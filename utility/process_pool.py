@@ -0,0 +1,26 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+POOL_WORKERS = os.cpu_count() or 1
+
+_pool = None
+
+
+def get_process_pool():
+    """ Returns the process pool shared by the batch jobs of the node.
+
+    The pool is created on first use. On a single core there is nothing to
+    gain from it and None is returned, so callers run the work inline.
+    """
+    global _pool
+    if POOL_WORKERS < 2:
+        return None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS)
+    return _pool
+
+
+def chunked(items, chunks):
+    """ Splits items into at most `chunks` lists of consecutive items. """
+    size = max(1, -(-len(items) // max(1, chunks)))
+    return [items[start:start + size] for start in range(0, len(items), size)]
@@ -0,0 +1,98 @@
+import threading
+
+
+class RWLock:
+    """ A lock which is shared by readers and exclusive for writers.
+
+    Waiting writers block new readers, so a stream of reads can't starve a
+    write. A thread holding the lock can take it again for reading (and the
+    writer for writing), but a reader can't upgrade to writing.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__condition = threading.Condition(self.__lock)
+        self.__readers = 0
+        self.__writer = None
+        self.__writers_waiting = 0
+        # Nesting depth of the locks held by every thread.
+        self.__depths = {}
+        self.__read = _Held(self.acquire_read, self.release_read)
+        self.__write = _Held(self.acquire_write, self.release_write)
+
+    def read(self):
+        """ Returns a context manager holding the lock for reading. """
+        return self.__read
+
+    def write(self):
+        """ Returns a context manager holding the lock exclusively. """
+        return self.__write
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        depth = self.__depths.get(me)
+        if depth:
+            # Reentrant, the thread already excludes the writers.
+            self.__depths[me] = depth + 1
+            return
+        with self.__lock:
+            while self.__writer is not None or self.__writers_waiting:
+                self.__condition.wait()
+            self.__readers += 1
+        self.__depths[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        depth = self.__depths[me] - 1
+        if depth:
+            self.__depths[me] = depth
+            return
+        del self.__depths[me]
+        with self.__lock:
+            self.__readers -= 1
+            if not self.__readers and self.__writers_waiting:
+                self.__condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self.__writer == me:
+            self.__depths[me] += 1
+            return
+        if self.__depths.get(me):
+            raise RuntimeError('A read lock can not be upgraded to write')
+        with self.__lock:
+            self.__writers_waiting += 1
+            try:
+                while self.__writer is not None or self.__readers:
+                    self.__condition.wait()
+            finally:
+                self.__writers_waiting -= 1
+            self.__writer = me
+        self.__depths[me] = 1
+
+    def release_write(self):
+        me = threading.get_ident()
+        depth = self.__depths[me] - 1
+        if depth:
+            self.__depths[me] = depth
+            return
+        del self.__depths[me]
+        with self.__lock:
+            self.__writer = None
+            self.__condition.notify_all()
+
+
+class _Held:
+    """ Context manager calling acquire and release, shared by all threads.
+    """
+    __slots__ = ('acquire', 'release')
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
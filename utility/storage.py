@@ -0,0 +1,376 @@
+import binascii
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from block import Block
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+BLOCK_CACHE_SIZE = 256
+# Payload length, crc32 of key and payload, 32 bytes key (the block hash).
+RECORD_HEADER = struct.Struct('>II32s')
+
+
+def save_json(path, data):
+    """ Atomically replaces the file at path with the json of data and
+    returns the number of bytes written.
+    """
+    tmp_path = path + '.tmp'
+    content = json.dumps(data).encode()
+    with open(tmp_path, mode='wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(content)
+
+
+def load_json(path, default):
+    """ Returns the json stored at path, default if it can't be read. """
+    try:
+        with open(path, mode='r') as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return default
+
+
+class Journal:
+    """ Changes to a snapshot, appended as json lines to numbered files.
+
+    Records are written under the lock of the caller and made durable by
+    sync, which doesn't need that lock. rotate starts the next file, so a
+    new snapshot can be saved while changes go on; remove_before then drops
+    the files the snapshot covers. A line torn by a crash ends the replay.
+    """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        sequences = self.sequences()
+        self.sequence = sequences[-1] if sequences else 0
+        # Records in the current file.
+        self.entries = 0
+        self.__fd = None
+        self.__retired = []
+        self.__lock = threading.Lock()
+        # Held while syncing or closing, so a file isn't closed mid fsync.
+        self.__sync_lock = threading.Lock()
+
+    def path(self, sequence):
+        return os.path.join(self.directory, '{}-{:06d}.journal'.format(
+            self.name, sequence))
+
+    def sequences(self):
+        """ Returns the sequence numbers of the stored files in order. """
+        prefix = self.name + '-'
+        return sorted(int(name[len(prefix):-8])
+                      for name in os.listdir(self.directory)
+                      if name.startswith(prefix) and
+                      name.endswith('.journal') and
+                      name[len(prefix):-8].isdigit())
+
+    def read(self, start):
+        """ Yields the records of the files from sequence start on. """
+        for sequence in self.sequences():
+            if sequence < start:
+                continue
+            with open(self.path(sequence), mode='rb') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line.decode())
+                    except ValueError:
+                        print('Ignoring the torn end of {}'.format(
+                            self.path(sequence)))
+                        return
+
+    def append(self, records):
+        """ Appends the records to the current file, returns the number of
+        bytes written. They are durable after the next sync.
+        """
+        data = b''.join(json.dumps(record).encode() + b'\n'
+                        for record in records)
+        with self.__lock:
+            if self.__fd is None:
+                self.__fd = os.open(self.path(self.sequence),
+                                    os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            os.write(self.__fd, data)
+            self.entries += len(records)
+        return len(data)
+
+    def sync(self):
+        """ Flushes the appended records to the disk. """
+        with self.__sync_lock:
+            with self.__lock:
+                fds = self.__retired + ([] if self.__fd is None
+                                        else [self.__fd])
+            for fd in fds:
+                os.fsync(fd)
+
+    def rotate(self):
+        """ Starts the next file and returns its sequence number. The
+        snapshot saved for it has to contain every change appended before.
+        """
+        with self.__lock:
+            if self.__fd is not None:
+                self.__retired.append(self.__fd)
+                self.__fd = None
+            self.sequence += 1
+            self.entries = 0
+            return self.sequence
+
+    def remove_before(self, sequence):
+        """ Removes the files a saved snapshot covers. """
+        with self.__sync_lock:
+            with self.__lock:
+                retired, self.__retired = self.__retired, []
+            for fd in retired:
+                os.close(fd)
+            for stale in self.sequences():
+                if stale < sequence:
+                    os.remove(self.path(stale))
+
+
+class BlockLog:
+    """ Append-only log with one record per block, split into segments.
+
+    Every record is framed by its length, crc32 and key, so the offsets of
+    the records can be indexed by height and by key from the headers alone.
+    A record torn by a crash is detected and cut off when the log is opened.
+    Records are read through memory maps of the segments.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        # (segment, offset, length) of the payload of every record by height.
+        self.__positions = []
+        self.__keys = []
+        self.__heights = {}
+        self.__maps = {}
+        # Readers of the blockchain share the maps of the segments.
+        self.__maps_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.__recover()
+
+    def __len__(self):
+        return len(self.__positions)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'blocks-{:06d}.log'.format(
+            segment))
+
+    def __segments(self):
+        segments = sorted(int(name[7:13]) for name in
+                          os.listdir(self.directory)
+                          if name.startswith('blocks-') and
+                          name.endswith('.log'))
+        return segments
+
+    def __map(self, segment, size):
+        """ Returns a memory map covering at least size bytes of segment. """
+        segment_map = self.__maps.get(segment)
+        if segment_map is None or len(segment_map) < size:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self.segment_path(segment), mode='rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__maps[segment] = segment_map
+        return segment_map
+
+    def __unmap(self, segment):
+        segment_map = self.__maps.pop(segment, None)
+        if segment_map is not None:
+            segment_map.close()
+
+    def __recover(self):
+        """ Indexes the record headers and truncates a torn tail record.
+
+        Only the tail record can be torn by an interrupted append, so only
+        its checksum is verified.
+        """
+        segments = self.__segments()
+        for position, segment in enumerate(segments):
+            path = self.segment_path(segment)
+            size = os.path.getsize(path)
+            segment_map = self.__map(segment, size) if size > 0 else b''
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                length, checksum, key = RECORD_HEADER.unpack_from(
+                    segment_map, offset)
+                start = offset + RECORD_HEADER.size
+                if start + length > size:
+                    break
+                if start + length == size and (zlib.crc32(
+                        segment_map[start:start + length],
+                        zlib.crc32(key)) != checksum):
+                    break
+                self.__index(segment, start, length, key)
+                offset = start + length
+            if offset < size:
+                print('Truncating torn block record in {}'.format(path))
+                self.__unmap(segment)
+                with open(path, mode='r+b') as f:
+                    f.truncate(offset)
+                for stale in segments[position + 1:]:
+                    self.__unmap(stale)
+                    os.remove(self.segment_path(stale))
+                break
+
+    def __index(self, segment, offset, length, key):
+        self.__positions.append((segment, offset, length))
+        self.__keys.append(key)
+        self.__heights[key] = len(self.__positions) - 1
+
+    def append(self, payload, key):
+        """ Appends a record and returns its height.
+
+        Arguments:
+            :payload: The bytes of the record.
+            :key: The 32 bytes under which the record is indexed.
+        """
+        if self.__positions:
+            segment, offset, length = self.__positions[-1]
+            end = offset + length
+            if end + RECORD_HEADER.size + len(payload) > self.segment_size:
+                segment, end = segment + 1, 0
+        else:
+            segment, end = 0, 0
+        with open(self.segment_path(segment), mode='ab') as f:
+            f.write(RECORD_HEADER.pack(
+                len(payload), zlib.crc32(payload, zlib.crc32(key)), key))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self.__index(segment, end + RECORD_HEADER.size, len(payload), key)
+        return len(self.__positions) - 1
+
+    def read(self, height):
+        """ Returns the payload of the record at the given height. """
+        segment, offset, length = self.__positions[height]
+        with self.__maps_lock:
+            return self.__map(segment, offset + length)[
+                offset:offset + length]
+
+    def key(self, height):
+        """ Returns the key of the record at the given height. """
+        return self.__keys[height]
+
+    def height(self, key):
+        """ Returns the height of the record with the given key or None. """
+        return self.__heights.get(key)
+
+    def truncate(self, height):
+        """ Removes every record from the given height on. """
+        if height >= len(self.__positions):
+            return
+        segment, offset, length = self.__positions[height]
+        for stale in self.__segments():
+            if stale >= segment:
+                self.__unmap(stale)
+            if stale > segment:
+                os.remove(self.segment_path(stale))
+        if offset == RECORD_HEADER.size:
+            os.remove(self.segment_path(segment))
+        else:
+            with open(self.segment_path(segment), mode='r+b') as f:
+                f.truncate(offset - RECORD_HEADER.size)
+        for key in self.__keys[height:]:
+            self.__heights.pop(key, None)
+        del self.__positions[height:]
+        del self.__keys[height:]
+
+    def close(self):
+        for segment in list(self.__maps):
+            self.__unmap(segment)
+
+
+class BlockStore:
+    """ The chain, kept on disk in a BlockLog and indexed by height and hash.
+
+    Blocks are only materialized when they are accessed and the most
+    recently used ones are kept in memory. The store behaves like a read
+    only list of blocks which can be appended to and truncated.
+    """
+
+    def __init__(self, directory, cache_size=BLOCK_CACHE_SIZE):
+        self.__log = BlockLog(directory)
+        self.__cache = OrderedDict()
+        self.__cache_size = cache_size
+        self.__cache_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__log)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.__block(height)
+                    for height in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('block height out of range')
+        return self.__block(item)
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self.__block(height)
+
+    def __block(self, height):
+        with self.__cache_lock:
+            block = self.__cache.get(height)
+            if block is not None:
+                self.__cache.move_to_end(height)
+                return block
+        block = Block.from_dict(json.loads(
+            self.__log.read(height).decode()), trusted=True)
+        self.__cache_block(height, block)
+        return block
+
+    def __cache_block(self, height, block):
+        with self.__cache_lock:
+            self.__cache[height] = block
+            if len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+
+    def append(self, block):
+        """ Appends the block to the log and returns its height. """
+        height = self.__log.append(self.block_record(block),
+                                   binascii.unhexlify(block.hash))
+        self.__cache_block(height, block)
+        return height
+
+    def truncate(self, height):
+        """ Removes every block from the given height on. """
+        self.__log.truncate(height)
+        with self.__cache_lock:
+            for cached in [cached for cached in self.__cache
+                           if cached >= height]:
+                del self.__cache[cached]
+
+    def hash_at(self, height):
+        """ Returns the hash of the block at the given height. """
+        return binascii.hexlify(self.__log.key(height)).decode('ascii')
+
+    def height_of(self, block_hash):
+        """ Returns the height of the block with the given hash or None. """
+        try:
+            return self.__log.height(binascii.unhexlify(block_hash))
+        except (binascii.Error, TypeError):
+            return None
+
+    def records(self, start=0, end=None):
+        """ Returns the stored json of the blocks in [start, end). """
+        return [self.__log.read(height)
+                for height in range(*slice(start, end).indices(len(self)))]
+
+    def close(self):
+        self.__log.close()
+
+    @staticmethod
+    def block_record(block):
+        """ Returns the bytes stored in the block log for the block. """
+        return json.dumps(block.to_dict()).encode()
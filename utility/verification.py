@@ -1,45 +1,99 @@
-from utility.hash_util import hash_string_256, hash_block
+import hashlib
+
+from utility.difficulty import Difficulty, target_bytes, target_hex
+from utility.merkle import merkle_root
+from utility.process_pool import POOL_WORKERS, chunked, get_process_pool
 from wallet import Wallet
 
+# Below this many blocks the proofs are checked in the calling process.
+PARALLEL_VERIFY_BLOCKS = 64
+
+
+def _valid_headers(header_inputs):
+    return all(Verification.valid_header(*header_input)
+               for header_input in header_inputs)
+
 
 class Verification:
 
     @classmethod
-    def verify_transactions(cls, open_transactions, get_balance):
-        """ Verifies all the open transactions. """
-        return all([cls.verify_transaction(tx, get_balance, False)
-                    for tx in open_transactions])
+    def verify_chain(cls, blockchain, previous_hash=None, difficulty=None,
+                     block_at=None):
+        """ Verifies all the blocks in the blockchain.
 
-    @classmethod
-    def verify_chain(cls, blockchain):
-        """ Verifies all the blocks in the blockchain. """
+        The Merkle roots, hash links, difficulty targets and timestamps are
+        checked in order, the headers (proof of work and block hash) of long
+        chains are checked in chunks on the process pool.
+
+        Arguments:
+            :blockchain: The blocks which should be verified.
+            :previous_hash: The hash of the block preceding the first one,
+                            None if the first block is the genesis block.
+            :difficulty: The retargeting rule the targets must follow.
+            :block_at: Returns the block at a height below the first one,
+                       needed unless the first block is the genesis block.
+        """
+        difficulty = Difficulty() if difficulty is None else difficulty
+
+        def lookup(height):
+            offset = height - blockchain[0].index
+            return blockchain[offset] if offset >= 0 else block_at(height)
+
+        if not all(Wallet.verify_transactions(
+                [tx for block in blockchain for tx in block.transactions])):
+            print('A transaction signature is invalid')
+            return False
+        header_inputs = []
         for (index, block) in enumerate(blockchain):
+            if block.merkle_root != merkle_root(
+                    [tx.tx_id for tx in block.transactions]):
+                print('Merkle root is invalid')
+                return False
             if index == 0:
-                continue
-            if block.previous_hash != hash_block(blockchain[index-1]):
+                if previous_hash is None:
+                    continue
+                expected_hash = previous_hash
+            else:
+                expected_hash = blockchain[index-1].hash
+                if block.index != blockchain[index-1].index + 1:
+                    return False
+            if block.previous_hash != expected_hash:
+                return False
+            if block.target != target_hex(difficulty.next_target(
+                    block.index, lookup)):
+                print('Difficulty target is invalid')
                 return False
-            if not cls.valid_proof(block.transactions[:-1],
-                                   block.previous_hash,
-                                   block.proof):
-                print('Proof of work is invalid')
+            try:
+                header_inputs.append(cls.header_input(block))
+            except ValueError:
                 return False
+            if not difficulty.valid_timestamp(block.index, block.timestamp,
+                                              lookup):
+                print('Block timestamp is invalid')
+                return False
+        pool = get_process_pool()
+        if pool is None or len(header_inputs) < PARALLEL_VERIFY_BLOCKS:
+            headers_valid = _valid_headers(header_inputs)
+        else:
+            headers_valid = all(pool.map(_valid_headers, chunked(
+                header_inputs, POOL_WORKERS * 4)))
+        if not headers_valid:
+            print('Proof of work is invalid')
+            return False
         return True
 
     @staticmethod
-    def verify_transaction(transaction, get_balance, sender=None,
-                           check_funds=True):
-        """ Verifies the given transaction. """
-        if check_funds:
-            return (transaction.amount <= get_balance(transaction.sender) and
-                    Wallet.verify_transaction(transaction))
-        else:
-            return Wallet.verify_transaction(transaction)
+    def header_input(block):
+        """ Returns the arguments of valid_header for the block, raises
+        ValueError on malformed headers.
+        """
+        return (block.header_prefix(block.index, block.previous_hash,
+                                    block.merkle_root, block.timestamp,
+                                    block.target),
+                block.proof, block.hash, target_bytes(block.target))
 
     @staticmethod
-    def valid_proof(transactions, last_hash, proof):
-        """ Validates the proof of work. """
-        guess = (str([tx.to_ordered_dict() for tx in transactions]
-                     ) + str(last_hash) + str(proof)).encode()
-        guess_hash = hash_string_256(guess)
-        # print(guess_hash)
-        return guess_hash[0:2] == '00'
+    def valid_header(prefix, proof, block_hash, target):
+        """ Validates the proof of work and the hash of a block header. """
+        digest = hashlib.sha256(prefix + str(proof).encode()).digest()
+        return digest < target and digest.hex() == block_hash
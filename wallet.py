@@ -1,16 +1,107 @@
-from Crypto.PublicKey import RSA
+from Crypto.PublicKey import ECC, RSA
 from Crypto.Hash import SHA256
-from Crypto.Signature import PKCS1_v1_5
+from Crypto.Signature import PKCS1_v1_5, eddsa
 import Crypto.Random
 import binascii
+import functools
+
+from utility import metrics
+from utility.process_pool import POOL_WORKERS, chunked, get_process_pool
+
+KEY_TYPE_RSA = 'rsa'
+KEY_TYPE_ED25519 = 'ed25519'
+KEY_TYPES = [KEY_TYPE_RSA, KEY_TYPE_ED25519]
+PUBLIC_KEY_CACHE_SIZE = 4096
+# Below this many signatures a batch is verified in the calling process.
+PARALLEL_VERIFY_THRESHOLD = 256
+
+# DER encoding of the Ed25519 algorithm identifier (OID 1.3.101.112), it
+# is part of the public and of the private keys.
+_ED25519_OID = b'\x06\x03\x2b\x65\x70'
+
+
+def key_type(key):
+    """ Returns the type of the DER encoded (binary) public or private
+    key.
+    """
+    if _ED25519_OID in key[:16]:
+        return KEY_TYPE_ED25519
+    return KEY_TYPE_RSA
+
+
+def _signed_message(sender, recipient, amount):
+    return (str(sender) + str(recipient) + str(amount)).encode('utf8')
+
+
+@functools.lru_cache(maxsize=PUBLIC_KEY_CACHE_SIZE)
+def _verifier(public_key):
+    """ Returns the verify function of a hex encoded public key. """
+    key = binascii.unhexlify(public_key)
+    if key_type(key) == KEY_TYPE_ED25519:
+        return _Ed25519Verifier(eddsa.new(ECC.import_key(key), 'rfc8032'))
+    verifier = PKCS1_v1_5.new(RSA.importKey(key))
+    return lambda message, signature: verifier.verify(SHA256.new(message),
+                                                      signature)
+
+
+class _Ed25519Verifier:
+    __slots__ = ('verifier',)
+
+    def __init__(self, verifier):
+        self.verifier = verifier
+
+    def __call__(self, message, signature):
+        try:
+            self.verifier.verify(message, signature)
+            return True
+        except ValueError:
+            return False
+
+
+def _verify_signature(sender, recipient, amount, signature):
+    if sender == 'MINING':
+        return True
+    try:
+        return _verifier(sender)(_signed_message(sender, recipient, amount),
+                                 binascii.unhexlify(signature))
+    except (ValueError, IndexError, TypeError, binascii.Error):
+        return False
+
+
+def _verify_signatures(signed_payloads):
+    return [_verify_signature(*payload) for payload in signed_payloads]
+
+
+def _verify_signed_payloads(signed_payloads):
+    """ Verifies the payloads, large batches on the process pool. """
+    pool = get_process_pool()
+    if pool is None or len(signed_payloads) < PARALLEL_VERIFY_THRESHOLD:
+        return _verify_signatures(signed_payloads)
+    results = []
+    for chunk_results in pool.map(_verify_signatures, chunked(
+            signed_payloads, POOL_WORKERS * 4)):
+        results.extend(chunk_results)
+    return results
 
 
 class Wallet:
 
-    def __init__(self, node_id):
+    def __init__(self, node_id, key_type=KEY_TYPE_RSA):
+        """
+        Arguments:
+            :node_id: The id of the node the wallet file belongs to.
+            :key_type: The type of the keys create_keys generates, rsa or
+                       ed25519. Loaded keys keep their own type.
+        """
+        if key_type not in KEY_TYPES:
+            raise ValueError('Unknown key type {}'.format(key_type))
         self.private_key = None
         self.public_key = None
         self.node_id = node_id
+        self.key_type = key_type
+        # The parsed private key, rebuilt when private_key changes.
+        self.__signer = None
+        self.__signer_key = None
 
     def create_keys(self):
         private_key, public_key = self.generate_keys()
@@ -41,6 +132,12 @@ class Wallet:
                 return False
 
     def generate_keys(self):
+        if self.key_type == KEY_TYPE_ED25519:
+            private_key = ECC.generate(curve='ed25519')
+            return (binascii.hexlify(private_key.export_key(format='DER'))
+                    .decode('ascii'),
+                    binascii.hexlify(private_key.public_key().export_key(
+                        format='DER')).decode('ascii'))
         private_key = RSA.generate(1024, Crypto.Random.new().read)
         public_key = private_key.publickey()
         return (binascii.hexlify(private_key.exportKey(format='DER'))
@@ -48,20 +145,45 @@ class Wallet:
                 binascii.hexlify(public_key.exportKey(format='DER'))
                 .decode('ascii'))
 
+    def __sign(self, message):
+        """ Signs the message with the private key, which is parsed only
+        once.
+        """
+        if self.__signer is None or self.__signer_key != self.private_key:
+            key = binascii.unhexlify(self.private_key)
+            if key_type(key) == KEY_TYPE_ED25519:
+                signer = eddsa.new(ECC.import_key(key), 'rfc8032')
+                self.__signer = signer.sign
+            else:
+                signer = PKCS1_v1_5.new(RSA.importKey(key))
+                self.__signer = lambda data: signer.sign(SHA256.new(data))
+            self.__signer_key = self.private_key
+        return self.__signer(message)
+
     def sign_transaction(self, sender, recipient, amount):
-        signer = PKCS1_v1_5.new(RSA.importKey(binascii
-                                              .unhexlify(self.private_key)))
-        h = SHA256.new((str(sender) + str(recipient) +
-                        str(amount)).encode('utf8'))
-        signature = signer.sign(h)
+        signature = self.__sign(_signed_message(sender, recipient, amount))
         return binascii.hexlify(signature).decode('ascii')
 
     @staticmethod
     def verify_transaction(transaction):
-        if transaction.sender == 'MINING':
-            return True
-        public_key = RSA.importKey(binascii.unhexlify(transaction.sender))
-        verifier = PKCS1_v1_5.new(public_key)
-        h = SHA256.new((str(transaction.sender) + str(transaction.recipient) +
-                        str(transaction.amount)).encode('utf8'))
-        return verifier.verify(h, binascii.unhexlify(transaction.signature))
+        metrics.SIGNATURES_VERIFIED.inc()
+        with metrics.SIGNATURE_VERIFY_SECONDS.time():
+            return _verify_signature(transaction.sender,
+                                     transaction.recipient,
+                                     transaction.amount,
+                                     transaction.signature)
+
+    @staticmethod
+    def verify_transactions(transactions):
+        """ Returns whether the signature of each transaction is valid.
+
+        Large batches are split over the process pool.
+
+        Arguments:
+            :transactions: The transactions which should be verified.
+        """
+        signed_payloads = [(tx.sender, tx.recipient, tx.amount, tx.signature)
+                           for tx in transactions]
+        metrics.SIGNATURES_VERIFIED.inc(len(signed_payloads))
+        with metrics.SIGNATURE_VERIFY_SECONDS.time():
+            return _verify_signed_payloads(signed_payloads)